@@ -0,0 +1,75 @@
+'''
+>>> import logging
+>>> from StringIO import StringIO
+>>> out = StringIO()
+>>> log = logging.getLogger('async_log_doctest')
+>>> log.propagate = False
+>>> log.addHandler(logging.StreamHandler(out))
+>>> install(log, maxsize=10)
+>>> args = ['world']
+>>> log.warning('hello %s', args)
+>>> args.append('again')
+>>> log.handlers[0].flush()
+>>> out.getvalue()
+"hello ['world']\\n"
+'''
+import logging
+from Queue import Queue, Full
+from threading import Thread
+from metrics import REGISTRY
+
+
+def install(logger, maxsize):
+    ''' Wrap each of logger's handlers in an AsyncHandler '''
+    logger.handlers = [AsyncHandler(h, maxsize) for h in logger.handlers]
+
+
+class AsyncHandler(logging.Handler):
+    ''' Hand records to a background thread that passes them on to handler,
+    so the thread logging (e.g. paho's network thread) never waits on
+    stderr or syslog.  The queue is bounded: when it's full records are
+    dropped and counted rather than blocking.
+    '''
+    def __init__(self, handler, maxsize=1000):
+        logging.Handler.__init__(self)
+        self._handler = handler
+        self._q = Queue(maxsize=maxsize)
+        self.dropped = 0
+        self._dropped = REGISTRY.counter('log_dropped')
+        t = Thread(target=self._run, name='AsyncHandler')
+        t.daemon = True
+        t.start()
+
+    def emit(self, record):
+        # Render the message here - its arguments may change once the
+        # logging call returns.  Records filtered out by level never get
+        # this far, so they still cost nothing.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        try:
+            self._q.put_nowait(record)
+        except Full:
+            self.dropped += 1
+            self._dropped.inc()
+
+    def flush(self):
+        ''' Wait until everything queued so far has been written '''
+        self._q.join()
+        self._handler.flush()
+
+    def close(self):
+        self.flush()
+        self._handler.close()
+        logging.Handler.close(self)
+
+    def _run(self):
+        while True:
+            record = self._q.get()
+            try:
+                self._handler.handle(record)
+            finally:
+                self._q.task_done()
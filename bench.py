@@ -0,0 +1,342 @@
+"""
+Usage:
+  bench [options] auth
+  bench [options] topics
+  bench [options] startup
+  bench [options] metrics
+  bench [options] logging
+
+Benchmarks:
+  auth              authorized() outward search vs. TokenVerifier lookup
+  topics            Config.get_topics() calls/topic map builds per message
+  startup           Time to start things2c for sub-commands that do no I/O
+  metrics           Cost of recording counters/histograms
+  logging           Per-message logging overhead at INFO level
+
+Options:
+  -h --help         Print usage
+  -n --number=N     Iterations per measurement [default: 1000]
+  -r --runs=R       Process starts per startup measurement [default: 10]
+  --cmd=CMD         How to start things2c, e.g. the pyinstaller binary
+                    [default: python things2c.py]
+  -c --config=FILE  Configuration for startup [default: things2c.ini.example]
+"""
+from functools import partial
+
+
+def main(cli, timer, report, report_count):
+    number = int(cli.number)
+    if cli.auth:
+        bench_auth(number, timer, report)
+    elif cli.topics:
+        bench_topics(number, timer, report, report_count)
+    elif cli.startup:
+        bench_startup(int(cli.runs), cli.cmd, cli.config, timer, report)
+    elif cli.metrics:
+        bench_metrics(number, timer, report)
+    elif cli.logging:
+        bench_logging(number, timer, report)
+    else:
+        raise NotImplementedError()
+
+
+class BenchDone(Exception):
+    pass
+
+
+class BenchMsg(object):
+    def __init__(self, topic, payload=''):
+        self.topic = topic
+        self.payload = payload
+
+
+class StopMsg(object):
+    ''' Ends a consumer loop when it looks at the message '''
+    @property
+    def topic(self):
+        raise BenchDone()
+
+
+class BenchMqtt(object):
+    ''' Stands in for MqttClient: queues (or dispatches) msgs when the
+    consumer starts its loop, followed by a StopMsg if stop is set
+    '''
+    def __init__(self, msgs, msg_queue, stop=True):
+        from mqtt_client import TopicTrie
+        self.msg_queue = msg_queue
+        self._msgs = msgs
+        self._stop = stop
+        self._handlers = TopicTrie()
+
+    def loop_start(self):
+        for msg in self._msgs + ([StopMsg()] if self._stop else []):
+            self.msg_queue.put(msg)
+
+    def loop_forever(self):
+        for msg in self._msgs:
+            self._handlers.dispatch(msg)
+        raise BenchDone()
+
+    def add_handler(self, topic, handler):
+        self._handlers.add(topic, handler)
+
+    def publish(self, topic, payload=None):
+        pass
+
+
+class BenchNotify(object):
+    def notify(self, msg):
+        pass
+
+
+def run_consumer(consumer, msgs):
+    ''' Run consumer(mk_mqtt, msgs) until it runs out of messages '''
+    def mk_mqtt(log, topics=[], msg_queue=None):
+        return BenchMqtt(msgs, msg_queue)
+    try:
+        consumer(mk_mqtt, msgs)
+    except BenchDone:
+        pass
+
+
+def bench_auth(number, timer, report):
+    ''' Worst case for the outward search is a token that doesn't match
+    (all 61 hashes), best case is a token for the current second.
+    '''
+    import datetime as dt
+    from things2c import authorized, dt_salted_hash
+    from token_verifier import TokenVerifier
+
+    clock = [dt.datetime(2016, 1, 1, 0, 0, 0)]
+
+    def now(as_datetime=False):
+        return clock[0]
+
+    def tick():
+        clock[0] += dt.timedelta(seconds=1)
+
+    secret = 'mysecretkey'
+    good = dt_salted_hash(secret, clock[0])
+    tv = TokenVerifier.make(secret=secret, now=now, hash_fn=dt_salted_hash)
+
+    for name, candidate in (('match', good), ('no match', 'xxx')):
+        report('authorized() %s' % name, number,
+               timer(partial(authorized, candidate, secret, now),
+                     number=number))
+        report('TokenVerifier %s' % name, number,
+               timer(partial(tv.authorized, candidate), number=number))
+
+    def verify_advancing():
+        tick()
+        tv.authorized('xxx')
+    report('TokenVerifier advancing 1s/call', number,
+           timer(verify_advancing, number=number))
+
+
+def bench_topics(number, timer, report, report_count):
+    ''' Count get_topics() calls and topic map builds for each consumer,
+    split into one-off setup cost and cost per processed message.
+    '''
+    import datetime as dt
+    import things2c
+    from config import Config, _topics
+    from pkg_resources import resource_stream
+
+    counts = dict(calls=0, builds=0)
+
+    class CountingConfig(Config):
+        def get_topics(self, topics=None):
+            counts['calls'] += 1
+            return super(CountingConfig, self).get_topics(topics)
+
+        def _build_topics(self, topics):
+            counts['builds'] += 1
+            return super(CountingConfig, self)._build_topics(topics)
+
+    def now(as_datetime=False):
+        return dt.datetime.now() if as_datetime else 0
+
+    def mk_msgs(cfg, n):
+        topics = Config(None).get_topics()
+        token = things2c.dt_salted_hash(cfg.config.motionctl.authorized_id,
+                                        now(as_datetime=True))
+        return [[BenchMsg(topics.nfc_scan),
+                 BenchMsg(topics.nfc_scan_data, token),
+                 BenchMsg(topics.motion_filesync_queue, 'f.jpg'),
+                 BenchMsg(topics.motion_status_off)][i % 4]
+                for i in range(n)]
+
+    def motionctl(cfg, mk_mqtt, msgs):
+        things2c.motionctl(None, cfg, mk_mqtt, now, lambda: False,
+                           lambda: None, lambda: None,
+                           lambda log: BenchNotify())
+
+    def filemanager(cfg, mk_mqtt, msgs):
+        class BenchFmq(object):
+            def queue(self, **kwargs):
+                pass
+
+            def cancel(self):
+                pass
+        things2c.filemanger(None, cfg, mk_mqtt,
+                            lambda **kwargs: BenchFmq(), None, None, now)
+
+    def blinkctl(cfg, mk_mqtt, msgs):
+        # blinkctl drains its queue once per blink cycle, so it gets one
+        # message per sleep() rather than all of them at loop_start
+        pending = list(msgs)
+        clients = list()
+
+        def mk_mqtt_fed(log, topics=[], msg_queue=None):
+            clients.append(BenchMqtt([], msg_queue, stop=False))
+            return clients[-1]
+
+        def sleep(sec):
+            if not pending:
+                raise BenchDone()
+            clients[0].msg_queue.put(pending.pop())
+
+        things2c.blinkctl(None, cfg, mk_mqtt_fed, lambda pattern: None,
+                          sleep, lambda: 1)
+
+    def measure(consumer, n):
+        cfg = CountingConfig(resource_stream(things2c.__name__,
+                                             'things2c.ini.example'))
+        msgs = mk_msgs(cfg, n)
+        counts.update(calls=0, builds=0)
+        run_consumer(partial(consumer, cfg), msgs)
+        return counts['calls'], counts['builds']
+
+    for consumer in (motionctl, filemanager, blinkctl):
+        c1, b1 = measure(consumer, number)
+        c2, b2 = measure(consumer, 2 * number)
+        per_call, per_build = ((c2 - c1) / float(number),
+                               (b2 - b1) / float(number))
+        report_count('%s get_topics() setup' % consumer.__name__,
+                     c1 - per_call * number)
+        report_count('%s get_topics() per msg' % consumer.__name__, per_call)
+        report_count('%s topic map builds per msg' % consumer.__name__,
+                     per_build)
+
+    cfg = Config(None)
+    report('Build topic map', number,
+           timer(partial(cfg._build_topics, _topics), number=number))
+    report('Cached get_topics()', number,
+           timer(cfg.get_topics, number=number))
+    topics = cfg.get_topics()
+    report('topics.motion_status_on', number,
+           timer(lambda: topics.motion_status_on, number=number))
+
+
+def bench_metrics(number, timer, report):
+    from metrics import Registry
+    r = Registry()
+    c = r.counter('c')
+    h = r.histogram('h')
+    report('Counter.inc()', number, timer(c.inc, number=number))
+    report('Histogram.observe()', number,
+           timer(partial(h.observe, 0.005), number=number))
+    report('Histogram.timed() of a no-op', number,
+           timer(partial(h.timed, lambda: None), number=number))
+    report('no-op call, for comparison', number,
+           timer(lambda: None, number=number))
+
+
+def bench_logging(number, timer, report):
+    ''' What the message path pays for its debug logging with the level at
+    INFO: eager string building vs. deferred formatting, and
+    MqttClient._on_message as a whole.  Also the cost of an emitted INFO
+    record, written directly vs. through AsyncHandler.
+    '''
+    import datetime as dt
+    import logging
+    from os import devnull
+    from async_log import install
+    from mqtt_client import MqttClient, TopicTrie
+    from things2c import dt_salted_hash
+
+    logging.disable(logging.NOTSET)
+    log = logging.getLogger('bench_logging')
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    msg = BenchMsg('/nfc/scan/data/', 'a' * 40)
+
+    report('eager debug() string building', number,
+           timer(lambda: log.debug('mqtt._on_message() ' + msg.topic + ' ' +
+                                   str(msg.payload)), number=number))
+    report('deferred debug() formatting', number,
+           timer(lambda: log.debug('mqtt._on_message() %s %s',
+                                   msg.topic, msg.payload), number=number))
+
+    # The real handler, minus the network connection
+    client = MqttClient.__new__(MqttClient)
+    client._log = log
+    client._handlers = TopicTrie()
+    client._msg_queue = None
+    client._messages = client._dispatch_sec = BenchMetric()
+    report('MqttClient._on_message()', number,
+           timer(partial(client._on_message, None, None, msg),
+                 number=number))
+    report('dt_salted_hash()', number,
+           timer(partial(dt_salted_hash, 'secret', dt.datetime.now()),
+                 number=number))
+
+    with open(devnull, 'w') as null:
+        log.addHandler(logging.StreamHandler(null))
+        report('info() written directly', number,
+               timer(partial(log.info, 'motionctl() got %s, %s', msg.topic,
+                             msg.payload), number=number))
+        install(log, maxsize=number)
+        report('info() through AsyncHandler', number,
+               timer(partial(log.info, 'motionctl() got %s, %s', msg.topic,
+                             msg.payload), number=number))
+        log.handlers[0].flush()
+
+
+class BenchMetric(object):
+    def inc(self, n=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+def bench_startup(runs, cmd, config, timer, report):
+    ''' Wall time per process for sub-commands that return without network
+    I/O - 'publish' without a topic loads the configuration and lists the
+    valid topics.
+    '''
+    import shlex
+    from os import devnull
+    from subprocess import call
+
+    with open(devnull, 'w') as null:
+        for args in (['version'], ['--help'], ['-c', config, 'publish']):
+            report('startup: %s' % ' '.join(args), runs,
+                   timer(partial(call, shlex.split(cmd) + args, stdout=null,
+                                 stderr=null), number=runs))
+
+
+if __name__ == '__main__':
+    def _tcb_():
+        import logging
+        from attrdict import AttrDict
+        from docopt import docopt
+        from sys import argv
+        from timeit import timeit
+
+        # Keep debug output of the code under test out of the measurement
+        logging.disable(logging.DEBUG)
+        cli = AttrDict(dict([(i[0].replace('--', '').strip('<>'), i[1])
+                             for i in docopt(__doc__,
+                                             argv=argv[1:]).items()]))
+
+        def report(name, number, elapsed):
+            print '%-40s %10.2f usec/call' % (name, elapsed * 1e6 / number)
+
+        def report_count(name, count):
+            print '%-40s %10.2f' % (name, count)
+
+        return dict(cli=cli, timer=timeit, report=report,
+                    report_count=report_count)
+    main(**_tcb_())
@@ -0,0 +1,342 @@
+'''
+Chunked, resumable uploads to ownCloud (or any WebDAV server speaking its
+chunking protocol): a file larger than one chunk is sent as PUTs of
+"<path>-chunking-<transfer id>-<chunks>-<index>", which the server
+reassembles once it has them all.
+
+Chunks are read through mmap a block at a time, so memory use doesn't grow
+with the file size.  They're sent by parallel parts, each on its own
+connection, optionally capped to a total rate, and recorded in a
+checkpoint file as they complete: a failed upload resumes where it
+stopped, as long as the file hasn't changed.  With a deadline, connections
+time out by it and no chunk is started after it.
+
+Against a local stand-in that fails the 4th request:
+
+>>> import os, tempfile
+>>> from httplib import HTTPConnection
+>>> from time import time, sleep
+>>> d = tempfile.mkdtemp()
+>>> path = os.path.join(d, 'movie.avi')
+>>> with open(path, 'wb') as f:
+...     f.write(''.join(chr(i % 251) for i in range(10000)))
+>>> server = StandInServer.make(fail_after=3)
+>>> cu = ChunkedUploader.make(url='http://%s/oc' % server.host, user='u',
+...                           password='p', connection=HTTPConnection,
+...                           checkpoint_dir=d, chunk_size=1024, parts=1,
+...                           now=time, sleep=sleep)
+>>> cu.put('clips/movie.avi', path)  # doctest: +ELLIPSIS
+Traceback (most recent call last):
+...
+UploadError: PUT /oc/remote.php/webdav/clips/movie.avi-chunking-...: 503 ...
+
+Resuming sends only the 7 missing chunks:
+
+>>> server.fail_after = None
+>>> cu.put('clips/movie.avi', path)
+>>> server.chunks
+10
+>>> server.files['/oc/remote.php/webdav/clips/movie.avi'] == \\
+...     open(path, 'rb').read()
+True
+
+Two parts sharing a rate cap; files of up to one chunk are a single PUT:
+
+>>> cu = ChunkedUploader.make(url='http://%s/oc' % server.host, user='u',
+...                           password='p', connection=HTTPConnection,
+...                           checkpoint_dir=d, chunk_size=4096, parts=2,
+...                           now=time, sleep=sleep, rate=100000)
+>>> cu.put('clips/movie.avi', path)
+>>> server.chunks, server.puts
+(13, 13)
+>>> small = os.path.join(d, 'preview.jpg')
+>>> with open(small, 'wb') as f:
+...     f.write('jpg')
+>>> cu.put('clips/preview.jpg', small)
+>>> server.chunks, server.puts
+(13, 14)
+
+Nothing is sent once the deadline has passed:
+
+>>> cu.put('clips/movie.avi', path, deadline=time() - 1)
+Traceback (most recent call last):
+...
+UploadError: movie.avi: deadline passed
+>>> server.chunks
+13
+>>> sorted(os.listdir(d))
+['movie.avi', 'preview.jpg']
+>>> server.close()
+>>> os.remove(path); os.remove(small); os.rmdir(d)
+'''
+import json
+import os
+from base64 import b64encode
+from hashlib import sha1
+from mmap import mmap, ACCESS_READ, ALLOCATIONGRANULARITY
+from random import randint
+from threading import Lock, Thread
+from urllib import quote
+from urlparse import urlsplit
+from Queue import Queue, Empty
+from metrics import REGISTRY
+from pushover_notify import TokenBucket
+
+# Read (and throttle) this much of a chunk at a time
+BLOCK_SIZE = 1 << 16
+
+
+class UploadError(Exception):
+    pass
+
+
+class Throttle(object):
+    ''' A TokenBucket of bytes shared by the parts (rate 0: unlimited) '''
+    def __init__(self, rate, now, sleep):
+        self._lock = Lock()
+        self._sleep = sleep
+        self._bucket = (TokenBucket(rate=rate, burst=max(rate, BLOCK_SIZE),
+                                    now=now) if rate else None)
+
+    def consume(self, n):
+        if self._bucket:
+            with self._lock:
+                wait = self._bucket.take(n)
+            if wait:
+                self._sleep(wait)
+
+
+class Checkpoint(object):
+    ''' The chunks of one transfer that the server has, kept in a JSON file
+    (rewritten atomically) named for the local and remote paths
+    '''
+    def __init__(self, directory, path, remote_path, size, mtime,
+                 chunk_size):
+        self._lock = Lock()
+        self._path = os.path.join(directory, '%s.json' % sha1(
+            '%s\0%s' % (path, remote_path)).hexdigest())
+        self._state = dict(size=size, mtime=mtime, chunk_size=chunk_size)
+        try:
+            with open(self._path) as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            saved = dict()
+        if all(saved.get(k) == v for k, v in self._state.items()):
+            self._state = saved
+        else:
+            # New, or the file changed since - start over
+            self._state.update(transfer_id=randint(1, 1 << 31), done=[])
+
+    @property
+    def transfer_id(self):
+        return self._state['transfer_id']
+
+    def done(self):
+        return set(self._state['done'])
+
+    def completed(self, index):
+        with self._lock:
+            self._state['done'].append(index)
+            tmp = '%s.tmp' % self._path
+            with open(tmp, 'w') as f:
+                json.dump(self._state, f)
+            os.rename(tmp, self._path)
+
+    def remove(self):
+        if os.path.exists(self._path):
+            os.remove(self._path)
+
+
+class ChunkedUploader(object):
+    def __init__(self, url, user, password, connection, checkpoint_dir,
+                 chunk_size, parts, now, sleep, rate):
+        _, self._host, path, _, _ = urlsplit(url)
+        self._dav_path = '%s/remote.php/webdav/' % path.rstrip('/')
+        self._auth = 'Basic %s' % b64encode('%s:%s' % (user, password))
+        self._connection = connection
+        self._now = now
+        self._checkpoint_dir = checkpoint_dir
+        self._chunk_size = chunk_size
+        self._parts = parts
+        self._throttle = Throttle(rate, now, sleep)
+        self._sent = REGISTRY.counter('upload_bytes')
+        self._chunks = REGISTRY.counter('upload_chunks')
+
+    @classmethod
+    def make(cls, url, user, password, connection, checkpoint_dir, now, sleep,
+             chunk_size=8 << 20, parts=2, rate=0):
+        return ChunkedUploader(url, user, password, connection,
+                               checkpoint_dir, chunk_size, parts, now, sleep,
+                               rate)
+
+    def put(self, remote_path, path, deadline=None):
+        ''' Upload the file at path to remote_path (relative to the WebDAV
+        root); raises UploadError if any chunk failed or the deadline (in
+        now() time) passed
+        '''
+        st = os.stat(path)
+        url = self._dav_path + quote(remote_path.lstrip('/'))
+        if st.st_size <= self._chunk_size:
+            conn = self._connect(path, deadline)
+            try:
+                with open(path, 'rb') as f:
+                    self._send(conn, url, f, 0, st.st_size, chunked=False)
+            finally:
+                conn.close()
+            return
+
+        if not os.path.isdir(self._checkpoint_dir):
+            os.makedirs(self._checkpoint_dir)
+        checkpoint = Checkpoint(self._checkpoint_dir, path, remote_path,
+                                st.st_size, st.st_mtime, self._chunk_size)
+        count = (st.st_size + self._chunk_size - 1) // self._chunk_size
+        todo = Queue()
+        for index in sorted(set(range(count)) - checkpoint.done()):
+            todo.put(index)
+        errors = list()
+        workers = [Thread(target=self._part,
+                          args=(url, path, st.st_size, count, checkpoint,
+                                todo, errors, deadline),
+                          name='ChunkedUploader-%d' % (i + 1))
+                   for i in range(min(self._parts, todo.qsize()))]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        if errors:
+            raise errors[0]
+        checkpoint.remove()
+
+    def _connect(self, path, deadline):
+        if deadline is None:
+            return self._connection(self._host)
+        left = deadline - self._now()
+        if left <= 0:
+            raise UploadError('%s: deadline passed' % os.path.basename(path))
+        return self._connection(self._host, timeout=left)
+
+    def _part(self, url, path, size, count, checkpoint, todo, errors,
+              deadline):
+        ''' Send chunks until there are none left, one fails or the deadline
+        passes
+        '''
+        try:
+            conn = self._connect(path, deadline)
+        except Exception, e:
+            errors.append(e)
+            return
+        try:
+            with open(path, 'rb') as f:
+                while not errors:
+                    try:
+                        index = todo.get_nowait()
+                    except Empty:
+                        return
+                    if deadline is not None and self._now() >= deadline:
+                        raise UploadError('%s: deadline passed'
+                                          % os.path.basename(path))
+                    start = index * self._chunk_size
+                    self._send(conn, '%s-chunking-%d-%d-%d'
+                               % (url, checkpoint.transfer_id, count, index),
+                               f, start, min(self._chunk_size, size - start),
+                               chunked=True)
+                    checkpoint.completed(index)
+        except Exception, e:
+            errors.append(e)
+        finally:
+            conn.close()
+
+    def _send(self, conn, url, f, start, length, chunked):
+        conn.putrequest('PUT', url)
+        conn.putheader('Authorization', self._auth)
+        conn.putheader('Content-Length', str(length))
+        if chunked:
+            conn.putheader('OC-Chunked', '1')
+        conn.endheaders()
+        if length:
+            # mmap offsets must be multiples of the allocation granularity
+            base = start - start % ALLOCATIONGRANULARITY
+            m = mmap(f.fileno(), start + length - base, access=ACCESS_READ,
+                     offset=base)
+            try:
+                for offset in range(start - base, start - base + length,
+                                    BLOCK_SIZE):
+                    block = m[offset:min(offset + BLOCK_SIZE,
+                                         start - base + length)]
+                    self._throttle.consume(len(block))
+                    conn.send(block)
+            finally:
+                m.close()
+        response = conn.getresponse()
+        response.read()
+        if response.status >= 300:
+            raise UploadError('PUT %s: %d %s' % (url, response.status,
+                                                 response.reason))
+        self._sent.inc(length)
+        self._chunks.inc()
+
+
+class StandInServer(object):
+    ''' A local HTTP server standing in for ownCloud's WebDAV in tests: it
+    reassembles chunked uploads into files, and can be told to fail every
+    request after the first fail_after
+    '''
+    def __init__(self, fail_after):
+        import re
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+        from urllib import unquote
+        server = self
+        chunk_re = re.compile(r'^(.*)-chunking-(\d+)-(\d+)-(\d+)$')
+        self.fail_after = fail_after
+        self.files = dict()
+        self.puts = 0
+        self.chunks = 0
+        transfers = dict()
+        lock = Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_PUT(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                path = unquote(self.path)
+                with lock:
+                    ok = (server.fail_after is None or
+                          server.puts < server.fail_after)
+                    if ok:
+                        server.puts += 1
+                        match = chunk_re.match(path)
+                        if not match:
+                            server.files[path] = body
+                        else:
+                            server.chunks += 1
+                            name, tid, count, index = match.groups()
+                            chunks = transfers.setdefault((name, tid), {})
+                            chunks[int(index)] = body
+                            if len(chunks) == int(count):
+                                server.files[name] = ''.join(
+                                    chunks[i] for i in sorted(chunks))
+                self.send_response(201 if ok else 503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self._httpd = Server(('127.0.0.1', 0), Handler)
+        self.host = '127.0.0.1:%d' % self._httpd.server_port
+        t = Thread(target=self._httpd.serve_forever)
+        t.daemon = True
+        t.start()
+
+    @classmethod
+    def make(cls, fail_after=None):
+        return StandInServer(fail_after)
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
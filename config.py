@@ -1,5 +1,7 @@
-from attrdict import AttrDict
+import re
 from ConfigParser import SafeConfigParser
+from os import stat
+from threading import Lock
 
 _topics = {'motion':
            {'status': {'on': None,
@@ -13,15 +15,263 @@ _topics = {'motion':
             'detected': None},
            'nfc': {'scan':
                    {'data': None}},
-           'info': None}
+           'info': None,
+           'metrics': None}
+
+
+def color(value):
+    ''' A blink(1) color like 0xff,0x00,0x00 '''
+    if not re.match(r'^0x[0-9a-fA-F]{2}(,0x[0-9a-fA-F]{2}){2}$', value):
+        raise ValueError('expected a color like 0xff,0x00,0x00')
+    return value
+
+
+def nfc_mode(value):
+    ''' How nfc_scan reads tags: cycle (read, then sleep) or continuous '''
+    if value not in ('cycle', 'continuous'):
+        raise ValueError("expected 'cycle' or 'continuous'")
+    return value
+
+
+def topic_list(value):
+    ''' Comma separated topic filters
+
+    >>> topic_list('/motion/status/#, /info/')
+    ['/motion/status/#', '/info/']
+    '''
+    return [t.strip() for t in value.split(',') if t.strip()]
+
+
+# Marks options that must be set in the ini file
+REQUIRED = object()
+
+# section -> option -> (type, default)
+_schema = {'broker': {'host': (str, REQUIRED),
+                      'port': (int, 1883)},
+           'pushover': {'user': (str, REQUIRED),
+                        'token': (str, REQUIRED),
+                        'queue_size': (int, 50),
+                        'rate_per_min': (float, 30),
+                        'burst': (int, 5),
+                        'coalesce_sec': (float, 2)},
+           'nfc': {'scan_poll_sleep': (float, 5),
+                   'nfcpy_path': (str, ''),
+                   'mode': (nfc_mode, 'cycle'),
+                   'poll_interval': (float, 0.25),
+                   'debounce_sec': (float, 3),
+                   'heartbeat_sec': (float, 5),
+                   'backoff_sec': (float, 1),
+                   'backoff_max_sec': (float, 30),
+                   'reopen_after': (int, 3),
+                   'usb_reset_after': (int, 10),
+                   'usb_reset_cmd': (str, ''),
+                   'reboot_after': (int, 30)},
+           'watchdog': {'timeout_sec': (float, 30),
+                        'notification_count': (int, 1)},
+           'blink': {'sec_between_blinks': (float, 2),
+                     'show_status_sec': (float, 30),
+                     'recent_status_sec': (float, 10),
+                     'motion_on_color': (color, '0xff,0x00,0x00'),
+                     'motion_off_color': (color, '0x00,0xff,0x00'),
+                     'motion_detected_color': (color, '0xff,0xff,0x00'),
+                     'motion_filesync_start_color': (color, '0x00,0x00,0xff'),
+                     'motion_filesync_end_color': (color, '0x00,0xff,0xff'),
+                     'motion_filesync_cancel_color': (color,
+                                                      '0xff,0xff,0xff')},
+           'motionctl': {'authorized_id': (str, REQUIRED),
+                         'auth_timeout_sec': (float, 30),
+                         'scan_timeout_sec': (float, 10),
+                         'proc_poll_sleep': (float, 5),
+                         'motion_pidfile': (str, ''),
+                         'state_cache_sec': (float, 1)},
+           'filemanager': {'filesync_delay': (float, 30),
+                           'filestore_path': (str, '/var/lib/motion/storage'),
+                           'workers': (int, 2),
+                           'batch_window_sec': (float, 0),
+                           'batch_max_mb': (float, 50),
+                           'large_file_mb': (float, 10),
+                           'large_workers': (int, 1),
+                           'batch_retries': (int, 5),
+                           'batch_retry_sec': (float, 60),
+                           's3_dest': (str, ''),
+                           'oc_url': (str, ''),
+                           'oc_user': (str, ''),
+                           'oc_password': (str, ''),
+                           'oc_subdir': (str, ''),
+                           'journal_path': (str, ''),
+                           'journal_sync_sec': (float, 1),
+                           'index_path': (str, ''),
+                           'chunk_size_mb': (int, 8),
+                           'upload_parts': (int, 2),
+                           'max_kb_per_sec': (float, 0),
+                           'checkpoint_dir': (str,
+                                              '/var/lib/motion/checkpoints'),
+                           'local_dest': (str, ''),
+                           'retries': (int, 2),
+                           'retry_sec': (float, 10),
+                           'timeout_sec': (float, 3600)},
+           'relay': {'socket_path': (str, '/run/things2c/relay.sock')},
+           'metrics': {'publish_sec': (float, 60)},
+           'logging': {'queue_size': (int, 0)},
+           'queues': {'maxsize': (int, 1000),
+                      'latest_topics': (topic_list, '/motion/status/#')}}
+
+
+class ConfigError(ValueError):
+    pass
+
+
+class Section(object):
+    ''' Base for the slotted classes generated from _schema '''
+    __slots__ = ()
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__,
+                           ', '.join('%s=%r' % (k, self[k])
+                                     for k in self.keys()))
+
+
+def _section_class(name, options):
+    return type('%sSection' % name.title(), (Section,),
+                dict(__slots__=tuple(sorted(options))))
+
+
+_section_classes = dict([(name, _section_class(name, options))
+                         for name, options in _schema.items()])
+_sections_class = _section_class('config', _schema.keys())
+
+
+# Blink color option for each topic blinkctl shows
+_topic_colors = [('motion_status_on', 'motion_on_color'),
+                 ('motion_status_off', 'motion_off_color'),
+                 ('motion_detected', 'motion_detected_color'),
+                 ('motion_filesync_start', 'motion_filesync_start_color'),
+                 ('motion_filesync_end', 'motion_filesync_end_color'),
+                 ('motion_filesync_cancel', 'motion_filesync_cancel_color')]
+
+
+class FrozenDict(dict):
+    ''' A dict that can't be changed once built
+
+    >>> d = FrozenDict(a=1)
+    >>> d['a'] = 2
+    Traceback (most recent call last):
+    ...
+    TypeError: FrozenDict is read-only
+    '''
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('%s is read-only' % type(self).__name__)
+
+    __setitem__ = __delitem__ = __setattr__ = __delattr__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+
+class TopicMap(FrozenDict):
+    ''' Read-only topic name -> topic map.  Topics are also plain instance
+    attributes, so t.motion_status_on is an ordinary attribute lookup.
+    '''
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.__dict__.update(self)
 
 
 class Config(object):
     def __init__(self, ini_file):
         self._ini_file = ini_file
-        self.config = self._get_config(self._ini_file)
+        self._config = self._get_config(self._ini_file)
+        self._topic_map = None
+        self._topic_colors = None
+        self._path = None
+
+    @classmethod
+    def watch(cls, path, now, log, check_sec=2, stat=stat):
+        ''' Load path and reload it whenever it changes.  The file is
+        checked at most every check_sec seconds when config is read; a
+        changed file that doesn't validate is logged and the previous
+        configuration is kept.
 
-    def get_topics(self, topics=_topics):
+        >>> import os, tempfile
+        >>> from pkg_resources import resource_string
+        >>> ini = resource_string(__name__, 'things2c.ini.example')
+        >>> fd, path = tempfile.mkstemp()
+        >>> with os.fdopen(fd, 'w') as f: f.write(ini)
+        >>> class Log(object):
+        ...     def info(self, msg, *args): print msg % args
+        ...     error = info
+        >>> clock = [0]
+        >>> c = Config.watch(path, now=lambda: clock[0], log=Log())
+        >>> c.config.motionctl.scan_timeout_sec
+        10.0
+        >>> def edit(text, mtime):
+        ...     with open(path, 'w') as f: f.write(text)
+        ...     os.utime(path, (mtime, mtime))
+        >>> edit(ini.replace('scan_timeout_sec=10', 'scan_timeout_sec=20'), 1)
+        >>> c.config.motionctl.scan_timeout_sec  # not checked again yet
+        10.0
+        >>> clock[0] += 2
+        >>> c.config.motionctl.scan_timeout_sec  # doctest: +ELLIPSIS
+        Reloaded configuration from ...
+        20.0
+        >>> edit(ini.replace('scan_timeout_sec=10', 'scan_timeout_sec=x'), 2)
+        >>> clock[0] += 2
+        >>> c.config.motionctl.scan_timeout_sec  # doctest: +ELLIPSIS
+        Not reloading ...: [motionctl] scan_timeout_sec: ...
+        20.0
+        >>> os.remove(path)
+        '''
+        with open(path, 'rb') as cfgin:
+            cfg = Config(cfgin)
+        cfg._path = path
+        cfg._now = now
+        cfg._log = log
+        cfg._check_sec = check_sec
+        cfg._stat = stat
+        cfg._lock = Lock()
+        cfg._next_check = now() + check_sec
+        cfg._version = cfg._file_version()
+        return cfg
+
+    @property
+    def config(self):
+        ''' The current configuration snapshot - hold on to it only as long
+        as values need to be consistent with each other '''
+        if self._path and self._now() >= self._next_check:
+            self._check()
+        return self._config
+
+    def _file_version(self):
+        st = self._stat(self._path)
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def _check(self):
+        # Only one thread checks; the others use the current snapshot
+        if not self._lock.acquire(False):
+            return
+        try:
+            self._next_check = self._now() + self._check_sec
+            version = self._file_version()
+            if version == self._version:
+                return
+            self._version = version
+            with open(self._path, 'rb') as cfgin:
+                config = self._get_config(cfgin)
+            self._config = config
+            self._log.info('Reloaded configuration from %s', self._path)
+        except (ConfigError, IOError, OSError), e:
+            self._log.error('Not reloading %s: %s', self._path, e)
+        finally:
+            self._lock.release()
+
+    def get_topics(self, topics=None):
         '''
         >>> c = Config(None)
         >>> t = c.get_topics(topics={'motion':
@@ -34,7 +284,39 @@ class Config(object):
         /motion/status/on/
         >>> print t.motion_status_all
         /motion/status/#
+
+        The default topic map is only built once
+        >>> c.get_topics() is c.get_topics()
+        True
+        >>> c.get_topics().info = '/elsewhere/'
+        Traceback (most recent call last):
+        ...
+        TypeError: TopicMap is read-only
         '''
+        if topics is None:
+            if self._topic_map is None:
+                self._topic_map = self._build_topics(_topics)
+            return self._topic_map
+        return self._build_topics(topics)
+
+    def get_topic_colors(self):
+        ''' Topic -> blink color, built once per configuration
+        >>> from pkg_resources import resource_stream
+        >>> c = Config(resource_stream(__name__, 'things2c.ini.example'))
+        >>> c.get_topic_colors()['/motion/status/on/']
+        '0xff,0x00,0x00'
+        >>> c.get_topic_colors() is c.get_topic_colors()
+        True
+        '''
+        # Cached per configuration snapshot, so a reload rebuilds it
+        config = self.config
+        if self._topic_colors is None or self._topic_colors[0] is not config:
+            topics = self.get_topics()
+            self._topic_colors = (config, FrozenDict(
+                [(topics[t], config.blink[c]) for t, c in _topic_colors]))
+        return self._topic_colors[1]
+
+    def _build_topics(self, topics):
         def all_paths(topics):
             paths = []
 
@@ -51,21 +333,64 @@ class Config(object):
             ht(topics, paths)
             return paths
         paths = all_paths(topics)
-        return AttrDict(dict(zip(
+        return TopicMap(dict(zip(
             [p.strip('/').replace('/', '_').replace('#', 'all')
              for p in paths], paths)))
 
     def _get_config(self, rd):
-        ''' Parse configuration from input stream
+        ''' Parse configuration from input stream, converting and
+        validating every option against _schema up front
         >>> from pkg_resources import resource_stream
         >>> c = Config(resource_stream(__name__, 'things2c.ini.example'))
         >>> 'broker' in c.config.keys()
         True
         >>> c.config.broker.host == 'localhost'
         True
+        >>> c.config.broker.port
+        1883
+        >>> c.config.motionctl.scan_timeout_sec
+        10.0
+
+        >>> from StringIO import StringIO
+        >>> Config(StringIO('[broker]\\nhost=localhost\\nport=x'))
+        Traceback (most recent call last):
+        ...
+        ConfigError: [broker] port: invalid literal for int() with base 10: 'x'
+        >>> Config(StringIO('[broker]\\nport=1'))
+        Traceback (most recent call last):
+        ...
+        ConfigError: [broker] host is required
+        >>> Config(StringIO('[broker]\\nhots=localhost'))
+        Traceback (most recent call last):
+        ...
+        ConfigError: [broker] hots is not a known option
         '''
         if not rd:
             return None
         cp = SafeConfigParser()
         cp.readfp(rd)
-        return AttrDict(cp._sections)
+
+        sections = _sections_class()
+        for name, options in sorted(_schema.items()):
+            section = _section_classes[name]()
+            unknown = (set(cp.options(name)) - set(options)
+                       if cp.has_section(name) else set())
+            if unknown:
+                raise ConfigError('[%s] %s is not a known option' %
+                                  (name, ', '.join(sorted(unknown))))
+            for option, (convert, default) in sorted(options.items()):
+                if cp.has_option(name, option):
+                    # raw: values are used verbatim, as before (passwords
+                    # may contain '%')
+                    raw = cp.get(name, option, raw=True)
+                    try:
+                        value = convert(raw)
+                    except ValueError, e:
+                        raise ConfigError('[%s] %s: %s' % (name, option, e))
+                elif default is REQUIRED:
+                    raise ConfigError('[%s] %s is required' % (name, option))
+                else:
+                    value = default
+                setattr(section, option, value)
+            setattr(sections, name, section)
+        return sections
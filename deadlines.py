@@ -0,0 +1,62 @@
+from heapq import heappush, heappop
+
+
+class Deadlines(object):
+    ''' Named one-shot deadlines, so a loop can block until the next one
+    is due instead of polling.  Re-setting a name replaces its deadline;
+    stale heap entries are skipped lazily.
+
+    >>> d = Deadlines()
+    >>> d.timeout(now=10) is None
+    True
+    >>> d.set('status', 12)
+    >>> d.set('motion_on', 15)
+    >>> d.timeout(now=10)
+    2
+    >>> d.set('status', 20)
+    >>> d.timeout(now=10)
+    5
+    >>> d.pop_due(now=16)
+    ['motion_on']
+    >>> d.pop_due(now=16)
+    []
+    >>> d.cancel('status')
+    >>> d.timeout(now=16) is None
+    True
+    >>> d.set('a', 1); d.set('b', 1); d.timeout(now=5)
+    0
+    >>> d.pop_due(now=5)
+    ['a', 'b']
+    '''
+    def __init__(self):
+        self._heap = list()
+        self._due = dict()
+
+    def set(self, name, when):
+        self._due[name] = when
+        heappush(self._heap, (when, name))
+
+    def cancel(self, name):
+        self._due.pop(name, None)
+
+    def _prune(self):
+        while self._heap and self._due.get(self._heap[0][1]) != \
+                self._heap[0][0]:
+            heappop(self._heap)
+
+    def timeout(self, now):
+        ''' Seconds until the next deadline (never negative), or None '''
+        self._prune()
+        if not self._heap:
+            return None
+        return max(self._heap[0][0] - now, 0)
+
+    def pop_due(self, now):
+        due = list()
+        self._prune()
+        while self._heap and self._heap[0][0] <= now:
+            name = heappop(self._heap)[1]
+            del self._due[name]
+            due.append(name)
+            self._prune()
+        return due
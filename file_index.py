@@ -0,0 +1,198 @@
+'''
+An SQLite index of the files in filestore_path: size, mtime, content hash
+and, per destination (e.g. s3, owncloud), whether the file was uploaded.
+Scanning only hashes files whose size or mtime changed, so reconciling a
+large storage directory at startup is cheap, and uploads can skip files
+a destination already has without asking the remote.
+
+>>> import os, tempfile
+>>> d = tempfile.mkdtemp()
+>>> def write(name, data):
+...     with open(os.path.join(d, name), 'w') as f:
+...         f.write(data)
+>>> write('a.jpg', 'aaa'); write('b.avi', 'bbb')
+>>> index = FileIndex.make(':memory:')
+>>> index.is_empty()
+True
+>>> index.scan(d)
+['a.jpg', 'b.avi']
+>>> index.scan(d)
+[]
+>>> index.mark('a.jpg', 's3', DONE)
+>>> index.pending(['s3']), index.pending(['s3', 'owncloud'])
+(['b.avi'], ['a.jpg', 'b.avi'])
+
+Touching a file doesn't lose its upload status (same content); changing it
+does:
+
+>>> os.utime(os.path.join(d, 'a.jpg'), (0, 0))
+>>> index.refresh(os.path.join(d, 'a.jpg')), index.is_done('a.jpg', 's3')
+(False, True)
+>>> write('a.jpg', 'AAA')
+>>> index.refresh(os.path.join(d, 'a.jpg')), index.is_done('a.jpg', 's3')
+(True, False)
+
+Seeding marks what's indexed as uploaded, e.g. after the first scan of a
+store that was synced before the index existed:
+
+>>> index.seed(['owncloud'], exclude=['b.avi'])
+>>> index.pending(['owncloud']), index.is_empty()
+(['b.avi'], False)
+
+Deleted files drop out of the index:
+
+>>> os.remove(os.path.join(d, 'b.avi'))
+>>> index.scan(d), index.pending(['s3'])
+([], ['a.jpg'])
+>>> os.remove(os.path.join(d, 'a.jpg')); os.rmdir(d)
+'''
+import os
+import sqlite3
+from hashlib import sha1
+from threading import Lock
+try:
+    # Much faster on large directories (os.scandir in Python 3.5+)
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+DONE = 'done'
+FAILED = 'failed'
+
+_schema = '''
+create table if not exists files (
+    name text primary key,
+    size integer not null,
+    mtime real not null,
+    hash text not null);
+create table if not exists uploads (
+    name text not null references files(name) on delete cascade,
+    dest text not null,
+    status text not null,
+    primary key (name, dest));
+'''
+
+
+def _stats(directory):
+    ''' (name, size, mtime) of the regular files in directory '''
+    if scandir:
+        for entry in scandir(directory):
+            if entry.is_file(follow_symlinks=False):
+                st = entry.stat(follow_symlinks=False)
+                yield entry.name, st.st_size, st.st_mtime
+    else:
+        from stat import S_ISREG
+        for name in os.listdir(directory):
+            st = os.lstat(os.path.join(directory, name))
+            if S_ISREG(st.st_mode):
+                yield name, st.st_size, st.st_mtime
+
+
+def file_hash(path, blocksize=1 << 16):
+    h = sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), ''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class FileIndex(object):
+    ''' Safe to share between the file manager's worker threads '''
+    def __init__(self, path):
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.text_factory = str
+        self._db.execute('pragma foreign_keys = on')
+        self._db.execute('pragma journal_mode = wal')
+        self._db.executescript(_schema)
+
+    @classmethod
+    def make(cls, path):
+        return FileIndex(path)
+
+    def scan(self, directory):
+        ''' Bring the index up to date with directory; the names of new or
+        changed files
+        '''
+        with self._lock, self._db:
+            known = dict((name, (size, mtime)) for name, size, mtime in
+                         self._db.execute(
+                             'select name, size, mtime from files'))
+            changed = list()
+            for name, size, mtime in _stats(directory):
+                if known.pop(name, None) != (size, mtime):
+                    if self._update(os.path.join(directory, name), name,
+                                    size, mtime):
+                        changed.append(name)
+            self._db.executemany('delete from files where name = ?',
+                                 [(name,) for name in known])
+            return sorted(changed)
+
+    def refresh(self, path):
+        ''' Update the index entry for path; True if its content changed '''
+        st = os.stat(path)
+        name = os.path.basename(path)
+        with self._lock, self._db:
+            row = self._db.execute(
+                'select size, mtime from files where name = ?',
+                (name,)).fetchone()
+            if row == (st.st_size, st.st_mtime):
+                return False
+            return self._update(path, name, st.st_size, st.st_mtime)
+
+    def _update(self, path, name, size, mtime):
+        digest = file_hash(path)
+        row = self._db.execute('select hash from files where name = ?',
+                               (name,)).fetchone()
+        if row:
+            self._db.execute('update files set size = ?, mtime = ?, hash = ?'
+                             ' where name = ?', (size, mtime, digest, name))
+            if row[0] == digest:
+                return False
+        else:
+            self._db.execute('insert into files values (?, ?, ?, ?)',
+                             (name, size, mtime, digest))
+        # New content - no destination has it yet
+        self._db.execute('delete from uploads where name = ?', (name,))
+        return True
+
+    def mark(self, name, dest, status):
+        with self._lock, self._db:
+            self._db.execute(
+                'insert or replace into uploads values (?, ?, ?)',
+                (name, dest, status))
+
+    def is_done(self, name, dest):
+        with self._lock:
+            return self._db.execute(
+                'select 1 from uploads where name = ? and dest = ? and '
+                'status = ?', (name, dest, DONE)).fetchone() is not None
+
+    def is_empty(self):
+        with self._lock:
+            return self._db.execute(
+                'select 1 from files limit 1').fetchone() is None
+
+    def seed(self, dests, exclude=()):
+        ''' Mark every indexed file but exclude as uploaded to dests '''
+        exclude = set(exclude)
+        with self._lock, self._db:
+            names = [name for name, in self._db.execute(
+                'select name from files') if name not in exclude]
+            self._db.executemany(
+                'insert or replace into uploads values (?, ?, ?)',
+                [(name, dest, DONE) for name in names for dest in dests])
+
+    def pending(self, dests):
+        ''' Indexed files not yet uploaded to every one of dests '''
+        with self._lock:
+            return [name for name, in self._db.execute(
+                'select name from files where (select count(*) from uploads'
+                ' where uploads.name = files.name and status = ? and'
+                ' dest in (%s)) < ? order by name'
+                % ','.join('?' * len(dests)),
+                [DONE] + list(dests) + [len(dests)])]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -1,136 +1,468 @@
 '''
 >>> from time import sleep
->>> from Queue import Empty
 
 >>> log = MockLog()
 >>> test(log=log,
-...      mk_fmq=partial(FileManagerQueue.make, log, MockMqtt.make),
+...      mk_fmq=partial(FileManagerQueue.make, log, MockMqtt(log)),
 ...      sleep=sleep)
 >>> while not log.q.empty():
 ...     print log.q.get_nowait()
-Process FileManager-1 is alive!
-Process FileManager-2 is alive!
 MockMqtt:publish(topic,start_1)
 begin upload file_1
-finishing upload file_1
-MockMqtt:publish(topic,end_1)
-Process FileManager-1 is exiting!
-Process FileManager-3 is alive!
-MockMqtt:publish(topic,start_3)
-begin upload file_3
 delete file_2
 MockMqtt:publish(topic,cancel_2)
-Process FileManager-2 is exiting!
-finishing upload file_3
+MockMqtt:publish(topic,start_3)
+MockMqtt:publish(topic,start_4)
+begin upload file_3, file_4
+finishing upload file_1
+MockMqtt:publish(topic,end_1)
+finishing upload file_3, file_4
 MockMqtt:publish(topic,end_3)
-Process FileManager-3 is exiting!
+MockMqtt:publish(topic,end_4)
+
+Cancelling only cancels files still inside their delay - one that is due
+but waiting for a worker is uploaded:
+
+>>> log = MockLog()
+>>> test_cancel_due(log=log,
+...                 mk_fmq=partial(FileManagerQueue.make, log,
+...                                MockMqtt(MockLog())),
+...                 sleep=sleep)
+>>> while not log.q.empty():
+...     print log.q.get_nowait()
+upload file_1
+delete file_3
+upload file_2
+
+Due files are uploaded previews first, smallest first, and a large movie
+doesn't take the last free worker (or get cancelled while it waits for
+one):
+
+>>> log = MockLog()
+>>> test_priority(log=log,
+...               mk_fmq=partial(FileManagerQueue.make, log,
+...                              MockMqtt(MockLog())),
+...               sleep=sleep)
+>>> while not log.q.empty():
+...     print log.q.get_nowait()
+upload a.jpg, b.jpg
+upload c.jpg
+upload small.avi
+upload big.avi
+upload d.jpg
+upload huge.avi
+
+A failed upload is queued again, after a backoff, until it has failed
+retries times:
+
+>>> log = MockLog()
+>>> test_retry(log=log,
+...            mk_fmq=partial(FileManagerQueue.make, log,
+...                           MockMqtt(MockLog())),
+...            sleep=sleep)
+>>> while not log.q.empty():
+...     print log.q.get_nowait()
+upload file_1
+FileManagerQueue file_1 failed, retrying in 0.2s: network down
+upload file_2
+FileManagerQueue file_2 failed, retrying in 0.2s: network down
+upload file_1
+upload file_2
+FileManagerQueue file_2 failed, giving up: network down
 '''
 from functools import partial
-from multiprocessing import Process, Queue
-from Queue import Empty
+from heapq import heapify, heappush, heappop
+from itertools import count
+from os.path import basename, getsize, join, splitext
+from Queue import Queue
+from threading import Condition, Thread
+from time import time
+
+PREVIEW_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+MOVIE_EXTENSIONS = ('.avi', '.mp4', '.mkv', '.mov', '.swf', '.flv', '.3gp')
+PREVIEW, OTHER, MOVIE = range(3)
+
+
+def kind(filename):
+    '''
+    >>> kind('/var/lib/motion/01-20160101-snapshot.JPG'), kind('a.avi')
+    (0, 2)
+    '''
+    ext = splitext(filename)[1].lower()
+    return (PREVIEW if ext in PREVIEW_EXTENSIONS
+            else MOVIE if ext in MOVIE_EXTENSIONS else OTHER)
+
+
+def stored_size(directory, filename):
+    ''' Size of filename in directory (0 if it's gone) '''
+    try:
+        return getsize(join(directory, basename(filename)))
+    except OSError:
+        return 0
 
 
 def test(log, mk_fmq, sleep):
-    ''' Test the queued file manager - queue 3 files so that:
-     - file_1 uploads but file_2 is cancelled while waiting
-     - meanwhile, file_3 (already in progress) is allowed to finish
-
-    Note: It's not completely deterministic when these processes
-    run/finish.  So, the scheduling/processing load of the machine
-    may cause the test to fail.  Sleep times are chosen to make
-    passing very likely.
+    ''' Test the queued file manager - queue 4 files so that:
+     - file_1 starts uploading right away
+     - file_2 is cancelled while waiting
+     - file_3 and file_4 are queued after the cancel, so they upload (as
+       one batch) while file_1 is still in progress
+
+    Note: It's not completely deterministic when the workers run/finish.
+    So, the scheduling/processing load of the machine may cause the test
+    to fail.  Sleep times are chosen to make passing very likely.
     '''
-    def upload(log, msg):
-        log.debug('begin upload %s' % msg)
+    def upload(filenames):
+        log.debug('begin upload %s', ', '.join(filenames))
         sleep(1)
-        log.debug('finishing upload %s' % msg)
-
-    def delete(log, msg):
-        log.debug('delete %s' % msg)
-
-    fmq = mk_fmq()
-    for (wait_time, sleep_between), (fname, args) in zip(
-            ((3, 0.1), (5, 4), (0, 0.5)), [('file_%s' % i,
-                                            tuple([('topic', m)
-                                                   for m in
-                                                   ['start_%s' % i,
-                                                    'end_%s' % i,
-                                                    'cancel_%s' % i]]))
-                                           for i in range(1, 4)]):
-        fmq.queue(partial(upload, log, fname),
-                  partial(delete, log, fname),
-                  wait_time, *args)
-        sleep(sleep_between)
+        log.debug('finishing upload %s', ', '.join(filenames))
+
+    def delete(filename):
+        log.debug('delete %s', filename)
+
+    def queue(fmq, i, wait_time):
+        fmq.queue('file_%s' % i, wait_time,
+                  *[('topic', m % i)
+                    for m in ['start_%s', 'end_%s', 'cancel_%s']])
+
+    fmq = mk_fmq(upload=upload, delete=delete, workers=2, batch_window=0.1)
+    queue(fmq, 1, 0)
+    queue(fmq, 2, 10)
+    sleep(0.2)
     fmq.cancel()
-    fmq._join_all()
+    sleep(0.2)
+    queue(fmq, 3, 0)
+    queue(fmq, 4, 0)
+    fmq.close()
 
 
-class FileManager(Process):
-    def __init__(self, log, q, timeout, upload, delete, mqtt,
-                 start_msg, end_msg, cancel_msg):
-        super(FileManager, self).__init__()
-        self._log = log
-        self._q = q
-        self._timeout = timeout
-        self._upload = upload
-        self._delete = delete
-        self._mqtt = mqtt
-        self._start_msg = start_msg
-        self._end_msg = end_msg
-        self._cancel_msg = cancel_msg
-
-    def run(self):
-        self._log.debug('Process %s is alive!' % self.name)
-        try:
-            self._q.get(timeout=self._timeout)
-            self._delete()
-            self._mqtt.publish(*self._cancel_msg)
-        except Empty:
-            self._mqtt.publish(*self._start_msg)
-            self._upload()
-            self._mqtt.publish(*self._end_msg)
-        self._log.debug('Process %s is exiting!' % self.name)
+def test_cancel_due(log, mk_fmq, sleep):
+    ''' One worker: file_2 comes due while file_1 is uploading, then
+    a cancel arrives while file_3 is still waiting out its delay
+    '''
+    def upload(filenames):
+        log.debug('upload %s', ', '.join(filenames))
+        sleep(0.3)
 
-    def cancel(self):
-        self._q.put(None)
+    def delete(filename):
+        log.debug('delete %s', filename)
+
+    fmq = mk_fmq(upload=upload, delete=delete, workers=1, batch_max=1)
+
+    def queue(i, wait_time):
+        fmq.queue('file_%s' % i, wait_time,
+                  *[('topic', m % i)
+                    for m in ['start_%s', 'end_%s', 'cancel_%s']])
+
+    queue(1, 0)
+    queue(2, 0)
+    queue(3, 10)
+    sleep(0.1)
+    fmq.cancel()
+    fmq.close()
+
+
+def test_priority(log, mk_fmq, sleep):
+    ''' Queue a mix of files with the same delay, so they come due
+    together, to two workers; at most one may upload a large file and a
+    batch holds at most 10 bytes.  d.jpg comes due while big.avi is
+    uploading and huge.avi is waiting for the large file worker; a cancel
+    then doesn't touch huge.avi, which is past its delay.
+    '''
+    sizes = {'a.jpg': 2, 'b.jpg': 3, 'c.jpg': 6, 'd.jpg': 1, 'small.avi': 5,
+             'big.avi': 50, 'huge.avi': 100}
+
+    def upload(filenames):
+        log.debug('upload %s', ', '.join(filenames))
+        sleep(0.3 if sizes[filenames[0]] > 10 else 0.05)
+
+    fmq = mk_fmq(upload=upload, delete=None, workers=2, batch_window=0.1,
+                 size=sizes.get, batch_bytes=10, large_bytes=10,
+                 large_workers=1)
+
+    def queue(filename, wait_time):
+        fmq.queue(filename, wait_time, *[('topic', m % filename)
+                                         for m in ['start_%s', 'end_%s',
+                                                   'cancel_%s']])
+
+    for filename in ['huge.avi', 'c.jpg', 'big.avi', 'b.jpg', 'small.avi',
+                     'a.jpg']:
+        queue(filename, 0.1)
+    queue('d.jpg', 0.3)
+    sleep(0.45)
+    fmq.cancel()
+    fmq.close()
+
+
+def test_retry(log, mk_fmq, sleep):
+    ''' file_1's upload fails once and file_2's always; a cancel while
+    file_1 waits to be retried doesn't touch it
+    '''
+    failures = {'file_1': 1, 'file_2': 2}
+
+    def upload(filenames):
+        log.debug('upload %s', ', '.join(filenames))
+        if failures[filenames[0]]:
+            failures[filenames[0]] -= 1
+            raise IOError('network down')
+
+    fmq = mk_fmq(upload=upload, delete=None, workers=1, batch_max=1,
+                 retries=1, retry_sec=0.2)
+
+    def queue(i, wait_time):
+        fmq.queue('file_%s' % i, wait_time,
+                  *[('topic', m % i)
+                    for m in ['start_%s', 'end_%s', 'cancel_%s']])
+
+    queue(1, 0)
+    sleep(0.1)
+    fmq.cancel()
+    queue(2, 0.05)
+    sleep(0.3)
+    fmq.close()
+
+
+class FileJob(object):
+    def __init__(self, filename, start_msg, end_msg, cancel_msg, size):
+        self.filename = filename
+        self.start_msg = start_msg
+        self.end_msg = end_msg
+        self.cancel_msg = cancel_msg
+        self.cancelled = False
+        self.cancellable = True
+        self.attempts = 0
+        self.size = size
+        self.kind = kind(filename)
 
 
 class FileManagerQueue(object):
-    def __init__(self, log, mk_mqtt):
+    ''' A fixed pool of worker threads fed from a delay queue (a heap keyed
+    on due time).  Cancelling marks every job still inside its delay as
+    cancelled and makes it due immediately; workers cancel (delete)
+    cancelled jobs and upload the rest.  Jobs already past their delay are
+    uploaded, even if they're still waiting for a worker.
+
+    Jobs coming due within batch_window of each other (up to batch_max
+    jobs and batch_bytes, going by size(filename)) are handed to a single
+    upload(filenames) call, so one transfer session covers the whole batch.
+
+    Due jobs wait in a second heap, ranked: cancelled jobs first (deletes
+    are quick), then previews, other files and movies, smallest first - the
+    snapshot looked at on the phone isn't stuck behind a movie.  Batches
+    with files over large_bytes are limited to large_workers at a time, so
+    with more workers than that there's always one free for previews.
+
+    A failed upload is queued again (not cancellable: it's past its delay)
+    after retry_sec, doubling each time, until it has failed retries times.
+    Then it's left to the next restart, if there's a journal.
+
+    If given a journal (see journal.py), every job's progress is recorded
+    there so pending jobs survive a restart.
+    '''
+    def __init__(self, log, mqtt, upload, delete, workers, batch_window,
+                 batch_max, now, journal, size, batch_bytes, large_bytes,
+                 large_workers, retries, retry_sec):
         self._log = log
-        self._mk_mqtt = mk_mqtt
-        self._ul_list = list()
+        self._mqtt = mqtt
+        self._upload = upload
+        self._delete = delete
+        self._batch_window = batch_window
+        self._batch_max = batch_max
+        self._now = now
+        self._journal = journal
+        self._size = size
+        self._batch_bytes = batch_bytes
+        self._large_bytes = large_bytes
+        self._large_workers = large_workers
+        self._retries = retries
+        self._retry_sec = retry_sec
+        self._large_busy = 0
+        self._cond = Condition()
+        # (due, seq, job) waiting out their delay
+        self._heap = list()
+        # (rank, seq, job) due, best first
+        self._ready = list()
+        self._seq = count()
+        self._closed = False
+        self._workers = [Thread(target=self._work,
+                                name='FileManager-%d' % (i + 1))
+                         for i in range(workers)]
+        for w in self._workers:
+            w.daemon = True
+            w.start()
 
     @classmethod
-    def make(cls, log, mk_mqtt):
-        return FileManagerQueue(log, mk_mqtt)
-
-    def queue(self, upload, delete, timeout, start_msg, end_msg, cancel_msg):
-        p = FileManager(self._log, Queue(), timeout,
-                        upload=upload, delete=delete,
-                        mqtt=self._mk_mqtt(log=self._log),
-                        start_msg=start_msg, end_msg=end_msg,
-                        cancel_msg=cancel_msg)
-        self._ul_list.append(p)
-        p.start()
+    def make(cls, log, mqtt, upload, delete, workers=2, batch_window=0,
+             batch_max=20, now=time, journal=None, size=lambda f: 0,
+             batch_bytes=50 << 20, large_bytes=10 << 20, large_workers=1,
+             retries=5, retry_sec=60):
+        return FileManagerQueue(log, mqtt, upload, delete, workers,
+                                batch_window, batch_max, now, journal, size,
+                                batch_bytes, large_bytes, large_workers,
+                                retries, retry_sec)
+
+    def queue(self, filename, timeout, start_msg, end_msg, cancel_msg,
+              cancelled=False, cancellable=True):
+        ''' Queue filename for upload after timeout; if cancelled, for
+        deleting right away (e.g. a cancel restored from the journal).
+        Jobs that aren't cancellable are uploaded regardless of cancel().
+        '''
+        size = self._size(filename) or 0
+        with self._cond:
+            job = FileJob(filename, start_msg, end_msg, cancel_msg, size)
+            job.cancelled = cancelled
+            job.cancellable = cancellable
+            due = 0 if cancelled else self._now() + timeout
+            if self._journal:
+                self._journal.queued(filename, due, cancellable)
+                if cancelled:
+                    self._journal.cancel(filename)
+            heappush(self._heap, (due, next(self._seq), job))
+            self._cond.notify()
 
     def cancel(self):
-        for p in self._ul_list:
-            p.cancel()
+        with self._cond:
+            now = self._now()
+            heap = list()
+            for due, seq, job in self._heap:
+                if due > now and job.cancellable:
+                    # Cancelled jobs are due right away
+                    job.cancelled = True
+                    due = 0
+                    if self._journal:
+                        self._journal.cancel(job.filename)
+                heap.append((due, seq, job))
+            self._heap = heap
+            heapify(self._heap)
+            self._cond.notify_all()
 
-    def _join_all(self, timeout=None):
-        for p in self._ul_list:
-            p.join(timeout=timeout)
-            if not p.is_alive():
-                self._ul_list.remove(p)
+    def close(self):
+        ''' Wait for all queued jobs to finish and stop the workers '''
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for w in self._workers:
+            w.join()
+
+    def _rank(self, job):
+        return (not job.cancelled, job.kind, job.size)
+
+    def _release(self):
+        ''' Move due jobs to the ready heap; how long until more are due '''
+        if not self._heap:
+            return None
+        head = self._heap[0]
+        # Cancelled jobs are already due - don't hold them back
+        wait = head[0] + (0 if head[2].cancelled
+                          else self._batch_window) - self._now()
+        if wait > 0:
+            return wait
+        now = self._now()
+        while self._heap and self._heap[0][0] <= now:
+            _, seq, job = heappop(self._heap)
+            heappush(self._ready, (self._rank(job), seq, job))
+        return self._release()
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                wait = self._release()
+                if self._ready:
+                    batch, cancelled, large = self._pop_batch()
+                    if batch:
+                        self._large_busy += large
+                        return batch, cancelled, large
+                elif wait is None and self._closed:
+                    return None, None, None
+                self._cond.wait(wait)
+
+    def _pop_batch(self):
+        ''' Best ready jobs, all cancelled or not, within the batch limits;
+        nothing if the best is large and large_workers are busy
+        '''
+        batch = list()
+        cancelled = self._ready[0][2].cancelled
+        nbytes = 0
+        large = False
+        while self._ready and len(batch) < self._batch_max:
+            job = self._ready[0][2]
+            if job.cancelled != cancelled:
+                break
+            if not cancelled:
+                if batch and nbytes + job.size > self._batch_bytes:
+                    break
+                if job.size > self._large_bytes:
+                    if self._large_busy >= self._large_workers:
+                        break
+                    large = True
+            batch.append(heappop(self._ready)[2])
+            nbytes += job.size
+        return batch, cancelled, large
+
+    def _finished(self, large):
+        if large:
+            with self._cond:
+                self._large_busy -= 1
+                self._cond.notify_all()
+
+    def _retry(self, batch, error):
+        with self._cond:
+            for job in batch:
+                job.attempts += 1
+                if job.attempts > self._retries:
+                    self._log.error('FileManagerQueue %s failed, giving up: '
+                                    '%s', job.filename, error)
+                    continue
+                delay = self._retry_sec * 2 ** (job.attempts - 1)
+                self._log.error('FileManagerQueue %s failed, retrying in '
+                                '%ss: %s', job.filename, delay, error)
+                job.cancellable = False
+                due = self._now() + delay
+                if self._journal:
+                    self._journal.queued(job.filename, due, False)
+                heappush(self._heap, (due, next(self._seq), job))
+            self._cond.notify()
+
+    def _record(self, state, job):
+        if self._journal:
+            getattr(self._journal, state)(job.filename)
+
+    def _work(self):
+        while True:
+            batch, cancelled, large = self._next_batch()
+            if not batch:
+                return
+            try:
+                if cancelled:
+                    for job in batch:
+                        self._delete(job.filename)
+                        self._record('cancelled', job)
+                        self._mqtt.publish(*job.cancel_msg)
+                else:
+                    for job in batch:
+                        self._record('started', job)
+                        self._mqtt.publish(*job.start_msg)
+                    self._upload([job.filename for job in batch])
+                    for job in batch:
+                        self._record('done', job)
+                        self._mqtt.publish(*job.end_msg)
+            except Exception, e:
+                if cancelled:
+                    self._log.error('FileManagerQueue batch failed: %s', e)
+                else:
+                    self._retry(batch, e)
+            finally:
+                self._finished(large)
 
 
 class MockLog(object):
     def __init__(self):
         self.q = Queue()
 
-    def debug(self, msg):
-        self.q.put(msg)
+    def debug(self, msg, *args):
+        self.q.put(msg % args if args else msg)
+
+    error = debug
 
 
 class MockMqtt(object):
@@ -142,4 +474,4 @@ class MockMqtt(object):
         return MockMqtt(log)
 
     def publish(self, topic, payload):
-        self._log.debug('MockMqtt:publish(%s,%s)' % (topic, payload))
+        self._log.debug('MockMqtt:publish(%s,%s)', topic, payload)
@@ -0,0 +1,199 @@
+'''
+Append-only journal of the file manager's pending uploads, so a restart
+(or a reboot) doesn't lose the clips still waiting out filesync_delay.
+
+One record per line: "<state> <due> <filename>", state one of queued,
+kept (queued, but not cancellable), cancel, started, done or cancelled
+(due is only set for queued and kept).  A cancel record marks a queued
+file to be deleted rather than uploaded; cancelled records that it was.
+Loading replays the records and rewrites (compacts) the file to just the
+live entries; a torn last line, from a crash mid-write, is ignored.
+
+>>> import os, tempfile
+>>> path = os.path.join(tempfile.mkdtemp(), 'filesync.journal')
+>>> j = Journal.make(path, sync_sec=0)
+>>> j.load()
+([], [])
+>>> j.queued('a.jpg', due=130); j.queued('b.jpg', due=130)
+>>> j.cancel('a.jpg'); j.cancel('b.jpg')
+>>> j.queued('c.avi', due=140); j.queued('d.jpg', due=140)
+>>> j.queued('e.jpg', due=150, cancellable=False)
+>>> j.started('c.avi'); j.started('d.jpg'); j.done('d.jpg')
+>>> j.cancelled('a.jpg')
+>>> j.close()
+>>> with open(path, 'a') as f:
+...     f.write('queued 150 torn')
+>>> j = Journal.make(path, sync_sec=0)
+
+Files to cancel (b.jpg), then files to upload with their due times and
+whether they can be cancelled; c.avi started but never finished, so it's
+due right away:
+
+>>> j.load()
+(['b.jpg'], [('c.avi', 0, True), ('e.jpg', 150.0, False)])
+>>> print open(path).read(),
+queued 0 b.jpg
+cancel - b.jpg
+queued 0.0 c.avi
+kept 150.0 e.jpg
+>>> j.close()
+>>> os.remove(path); os.rmdir(os.path.dirname(path))
+'''
+import os
+from threading import Condition, Thread
+
+QUEUED = 'queued'
+KEPT = 'kept'
+STARTED = 'started'
+DONE = 'done'
+CANCELLED = 'cancelled'
+CANCEL = 'cancel'
+
+
+class Journal(object):
+    ''' Records are written (and flushed to the OS) as they happen; fsync
+    is batched: a background thread syncs at most every sync_sec, so a burst
+    of motion events costs one fsync (sync_sec=0 syncs every record).  The
+    file is compacted again once compact_after records have been appended.
+    '''
+    def __init__(self, path, sync_sec, compact_after):
+        self._path = path
+        self._sync_sec = sync_sec
+        self._compact_after = compact_after
+        self._cond = Condition()
+        self._f = None
+        # filename -> [state, due]
+        self._entries = dict()
+        self._appended = 0
+        self._dirty = False
+        self._closed = False
+        if sync_sec:
+            t = Thread(target=self._syncer, name='Journal')
+            t.daemon = True
+            t.start()
+
+    @classmethod
+    def make(cls, path, sync_sec=1, compact_after=1000):
+        return Journal(path, sync_sec, compact_after)
+
+    def load(self):
+        ''' Replay the journal: ([filename to cancel],
+        [(filename, due, cancellable) to upload])
+        '''
+        with self._cond:
+            self._entries = dict()
+            if os.path.exists(self._path):
+                with open(self._path) as f:
+                    for line in f:
+                        if line.endswith('\n'):
+                            self._apply(*line[:-1].split(' ', 2))
+            self._compact()
+            cancels = sorted(fn for fn, (state, _) in self._entries.items()
+                             if state == CANCEL)
+            pending = sorted(((fn, due, state != KEPT)
+                              for fn, (state, due) in self._entries.items()
+                              if state != CANCEL),
+                             key=lambda p: (p[1], p[0]))
+            return cancels, pending
+
+    def queued(self, filename, due, cancellable=True):
+        self._append(QUEUED if cancellable else KEPT, due, filename)
+
+    def started(self, filename):
+        self._append(STARTED, '-', filename)
+
+    def done(self, filename):
+        self._append(DONE, '-', filename)
+
+    def cancelled(self, filename):
+        self._append(CANCELLED, '-', filename)
+
+    def cancel(self, filename):
+        self._append(CANCEL, '-', filename)
+
+    def sync(self):
+        with self._cond:
+            self._sync()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._sync()
+            if self._f:
+                self._f.close()
+                self._f = None
+            self._cond.notify()
+
+    def _apply(self, state, due, filename):
+        ''' Update the live entries: queued files waiting (with due time),
+        started files (due now, if they never finish) and files to cancel
+        '''
+        if state in (QUEUED, KEPT):
+            self._entries[filename] = [state, float(due)]
+        elif state == STARTED:
+            if filename in self._entries:
+                self._entries[filename] = [STARTED, 0]
+        elif state in (DONE, CANCELLED):
+            self._entries.pop(filename, None)
+        elif state == CANCEL:
+            entry = self._entries.get(filename)
+            if entry and entry[0] == QUEUED:
+                entry[0] = CANCEL
+
+    def _append(self, state, due, filename):
+        with self._cond:
+            if self._f is None:
+                self._f = open(self._path, 'a')
+            self._apply(state, due, filename)
+            self._f.write('%s %s %s\n' % (state, due, filename))
+            self._f.flush()
+            self._appended += 1
+            if self._appended >= self._compact_after:
+                self._compact()
+            elif self._sync_sec:
+                self._dirty = True
+                self._cond.notify()
+            else:
+                os.fsync(self._f.fileno())
+
+    def _sync(self):
+        if self._dirty and self._f:
+            os.fsync(self._f.fileno())
+        self._dirty = False
+
+    def _compact(self):
+        ''' Atomically replace the journal with the live entries '''
+        if self._f:
+            self._f.close()
+            self._f = None
+        entries = sorted(self._entries.items(),
+                         key=lambda e: (e[1][1], e[0]))
+        lines = ['queued 0 %s\ncancel - %s\n' % (fn, fn)
+                 for fn, (state, _) in entries if state == CANCEL]
+        lines.extend('%s %r %s\n' % (KEPT if state == KEPT else QUEUED,
+                                     float(due), fn)
+                     for fn, (state, due) in entries if state != CANCEL)
+        tmp = '%s.tmp' % self._path
+        with open(tmp, 'w') as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self._path)
+        dirfd = os.open(os.path.dirname(os.path.abspath(self._path)),
+                        os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+        self._appended = 0
+        self._dirty = False
+
+    def _syncer(self):
+        with self._cond:
+            while not self._closed:
+                if not self._dirty:
+                    self._cond.wait()
+                    continue
+                # Let a burst of records gather, then sync them together
+                self._cond.wait(self._sync_sec)
+                self._sync()
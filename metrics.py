@@ -0,0 +1,120 @@
+'''
+A small in-process metrics registry: counters, gauges and fixed-bucket
+histograms, rendered in the Prometheus text format.  Recording is a few
+attribute updates (no locks - concurrent updates may rarely be lost, which
+is fine for monitoring).
+
+>>> r = Registry()
+>>> c = r.counter('mqtt_messages')
+>>> c.inc(); c.inc(2)
+>>> r.gauge('queue_depth').set(3)
+>>> h = r.histogram('upload_sec', buckets=(1, 10))
+>>> for v in (0.5, 2, 20):
+...     h.observe(v)
+>>> r.counter('mqtt_messages') is c
+True
+>>> print r.render()
+mqtt_messages 3
+queue_depth 3
+upload_sec_bucket{le="1"} 1
+upload_sec_bucket{le="10"} 2
+upload_sec_bucket{le="+Inf"} 3
+upload_sec_sum 22.5
+upload_sec_count 3
+'''
+from bisect import bisect_left
+from time import time as timer
+
+# Seconds, from sub-millisecond hot paths to slow uploads
+DEFAULT_BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1, 10, 60, 600)
+
+
+def publish(name, registry, mqtt, topics, sleep, interval):
+    ''' Publish registry to /metrics/<name>/ every interval seconds '''
+    topic = '%s%s/' % (topics.metrics, name)
+    while True:
+        sleep(interval)
+        mqtt.publish(topic, registry.render())
+
+
+class Counter(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def render(self, name):
+        return ['%s %s' % (name, self.value)]
+
+
+class Gauge(Counter):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram(object):
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def timed(self, fn, *args):
+        ''' fn(*args), observing how long it took '''
+        start = timer()
+        try:
+            return fn(*args)
+        finally:
+            self.observe(timer() - start)
+
+    def render(self, name):
+        lines = list()
+        total = 0
+        for le, n in zip(self.buckets + ('+Inf',), self.counts):
+            total += n
+            lines.append('%s_bucket{le="%s"} %d' % (name, le, total))
+        lines.append('%s_sum %s' % (name, self.sum))
+        lines.append('%s_count %d' % (name, self.count))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = dict()
+
+    def _get(self, name, make):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics.setdefault(name, make())
+        return metric
+
+    def counter(self, name):
+        return self._get(name, Counter)
+
+    def gauge(self, name):
+        return self._get(name, Gauge)
+
+    def histogram(self, name, buckets=DEFAULT_BUCKETS):
+        return self._get(name, lambda: Histogram(buckets))
+
+    def render(self):
+        lines = list()
+        for name, metric in sorted(self._metrics.items()):
+            lines.extend(metric.render(name))
+        return '\n'.join(lines)
+
+
+# The process-wide registry the daemons record into
+REGISTRY = Registry()
@@ -0,0 +1,91 @@
+from os import listdir, path as ospath
+
+
+class MotionState(object):
+    ''' Track whether the motion process is running by reading its pidfile
+    and /proc rather than forking pgrep.  The answer is cached for cache_sec
+    and invalidated whenever motion is started or stopped.
+
+    >>> import os, shutil, tempfile
+    >>> proc = tempfile.mkdtemp()
+    >>> def mkproc(pid, comm):
+    ...     os.mkdir(os.path.join(proc, str(pid)))
+    ...     with open(os.path.join(proc, str(pid), 'comm'), 'w') as f:
+    ...         f.write(comm + '\\n')
+    >>> mkproc(1, 'init'); mkproc(42, 'things2c')
+    >>> clock = [0]
+    >>> ms = MotionState.make(pidfile=None, now=lambda: clock[0],
+    ...                       cache_sec=1, proc_path=proc)
+    >>> ms.is_on()
+    False
+    >>> mkproc(99, 'motion')
+    >>> ms.is_on()  # cached
+    False
+    >>> ms.invalidate()
+    >>> ms.is_on()
+    True
+    >>> shutil.rmtree(os.path.join(proc, '99'))
+    >>> clock[0] += 2
+    >>> ms.is_on()
+    False
+    >>> pidfile = os.path.join(proc, 'motion.pid')
+    >>> with open(pidfile, 'w') as f: f.write('7\\n')
+    >>> mkproc(7, 'motion')
+    >>> ms = MotionState.make(pidfile=pidfile, now=lambda: clock[0],
+    ...                       cache_sec=1, proc_path=proc)
+    >>> ms.is_on()
+    True
+    >>> shutil.rmtree(proc)
+    '''
+    def __init__(self, pidfile, now, cache_sec, proc_path, comm):
+        self._pidfile = pidfile
+        self._now = now
+        self._cache_sec = cache_sec
+        self._proc_path = proc_path
+        self._comm = comm
+        self._pid = None
+        self._state = None
+        self._checked = None
+
+    @classmethod
+    def make(cls, pidfile, now, cache_sec=1, proc_path='/proc',
+             comm='motion'):
+        return MotionState(pidfile, now, cache_sec, proc_path, comm)
+
+    def invalidate(self):
+        self._state = None
+
+    def is_on(self):
+        if(self._state is None or
+           self._now() - self._checked >= self._cache_sec):
+            self._state = self._probe()
+            self._checked = self._now()
+        return self._state
+
+    def _is_motion(self, pid):
+        try:
+            with open(ospath.join(self._proc_path, str(pid), 'comm')) as f:
+                return f.read().strip() == self._comm
+        except IOError:
+            return False
+
+    def _probe(self):
+        # Cheapest first: the pid we saw last time, then motion's pidfile,
+        # and finally a scan of /proc
+        if self._pid and self._is_motion(self._pid):
+            return True
+        self._pid = None
+        if self._pidfile:
+            try:
+                with open(self._pidfile) as f:
+                    pid = int(f.read().strip())
+                if self._is_motion(pid):
+                    self._pid = pid
+                    return True
+            except (IOError, ValueError):
+                pass
+        for pid in listdir(self._proc_path):
+            if pid.isdigit() and self._is_motion(pid):
+                self._pid = pid
+                return True
+        return False
@@ -1,5 +1,9 @@
 import paho.mqtt.client as mqtt
+from collections import deque
 from functools import partial
+from Queue import Queue
+from threading import Event, Lock
+from metrics import REGISTRY, timer
 
 
 def main(mk_mqtt_client):
@@ -11,13 +15,180 @@ def main(mk_mqtt_client):
     client.loop_forever()
 
 
+class TopicTrie(object):
+    ''' MQTT topic filters (with + and # wildcards) compiled into a trie of
+    topic levels, so matching a topic costs one walk of its levels no
+    matter how many filters are registered.  Each matching handler is
+    returned once, in registration order.
+
+    >>> t = TopicTrie()
+    >>> t.add('/motion/status/#', 'status')
+    >>> t.add('/motion/+/on/', 'on')
+    >>> t.add('/nfc/scan/data/', 'data')
+    >>> t.add('/#', 'all')
+    >>> t.add('/motion/#', 'status')
+    >>> t.match('/motion/status/on/')
+    ['status', 'on', 'all']
+    >>> t.match('/motion/status')
+    ['status', 'all']
+    >>> t.match('/nfc/scan/data/')
+    ['data', 'all']
+    >>> t.match('/nfc/scan/')
+    ['all']
+    >>> t.match('motion')
+    []
+    '''
+    class _Node(object):
+        __slots__ = ('children', 'handlers')
+
+        def __init__(self):
+            self.children = dict()
+            self.handlers = list()
+
+    def __init__(self):
+        self._root = TopicTrie._Node()
+        self._order = dict()
+        self._lock = Lock()
+
+    def add(self, topic_filter, handler):
+        with self._lock:
+            node = self._root
+            for level in topic_filter.split('/'):
+                child = node.children.get(level)
+                if child is None:
+                    child = node.children[level] = TopicTrie._Node()
+                node = child
+            if handler not in self._order:
+                self._order[handler] = len(self._order)
+            node.handlers.append(handler)
+
+    def match(self, topic):
+        found = set()
+        nodes = [self._root]
+        for level in topic.split('/'):
+            next_nodes = list()
+            for node in nodes:
+                # '#' also matches the parent level ('a/#' matches 'a')
+                hashed = node.children.get('#')
+                if hashed:
+                    found.update(hashed.handlers)
+                for key in (level, '+'):
+                    child = node.children.get(key)
+                    if child:
+                        next_nodes.append(child)
+            nodes = next_nodes
+            if not nodes:
+                break
+        for node in nodes:
+            found.update(node.handlers)
+            hashed = node.children.get('#')
+            if hashed:
+                found.update(hashed.handlers)
+        return sorted(found, key=self._order.get)
+
+    def dispatch(self, msg):
+        for handler in self.match(msg.topic):
+            handler(msg)
+
+
+class MessageQueue(Queue):
+    ''' A bounded queue between the network thread and a consumer that
+    never blocks the network thread.  When full, the oldest message is
+    dropped.  For topics matching latest_topics (e.g. status topics) only
+    the newest pending message per topic is kept: it replaces the pending
+    one in place.
+
+    >>> class Msg(object):
+    ...     def __init__(self, topic, payload):
+    ...         self.topic, self.payload = topic, payload
+    >>> q = MessageQueue.make(name='doctest', maxsize=3,
+    ...                       latest_topics=['/motion/status/#'])
+    >>> for i in range(5):
+    ...     q.put(Msg('/motion/status/on/', i))
+    >>> for i in range(4):
+    ...     q.put(Msg('/motion/detected/', i))
+    >>> [(m.topic, m.payload) for m in [q.get() for i in range(q.qsize())]]
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [('/motion/detected/', 1), ('/motion/detected/', 2),
+     ('/motion/detected/', 3)]
+    >>> q.dropped, q.coalesced
+    (2, 4)
+    >>> q.put(Msg('/motion/status/on/', 'a'))
+    >>> q.put(Msg('/motion/status/off/', 'b'))
+    >>> q.put(Msg('/motion/status/on/', 'c'))
+    >>> [m.payload for m in [q.get() for i in range(q.qsize())]]
+    ['c', 'b']
+    '''
+    def __init__(self, name, maxsize, latest_topics):
+        Queue.__init__(self, maxsize)
+        self._latest = TopicTrie()
+        for topic in latest_topics:
+            self._latest.add(topic, True)
+        self._is_latest = dict()
+        self.dropped = 0
+        self.coalesced = 0
+        self._dropped = REGISTRY.counter('%s_queue_dropped' % name)
+        self._coalesced = REGISTRY.counter('%s_queue_coalesced' % name)
+
+    @classmethod
+    def make(cls, name, maxsize=1000, latest_topics=()):
+        return MessageQueue(name, maxsize, latest_topics)
+
+    # Queue's storage hooks - called with self.mutex held.  Entries are
+    # [msg] lists so a pending status message can be replaced in place.
+    def _init(self, maxsize):
+        self.queue = deque()
+        self._pending = dict()
+
+    def _qsize(self, len=len):
+        return len(self.queue)
+
+    def _get(self):
+        entry = self.queue.popleft()
+        msg = entry[0]
+        if self._pending.get(msg.topic) is entry:
+            del self._pending[msg.topic]
+        return msg
+
+    def _put(self, entry):
+        self.queue.append(entry)
+
+    def put(self, msg, block=True, timeout=None):
+        ''' Never blocks (block and timeout are ignored) '''
+        with self.mutex:
+            topic = msg.topic
+            latest = self._is_latest.get(topic)
+            if latest is None:
+                latest = self._is_latest[topic] = \
+                    bool(self._latest.match(topic))
+            if latest and topic in self._pending:
+                self._pending[topic][0] = msg
+                self.coalesced += 1
+                self._coalesced.inc()
+                return
+            if self.maxsize > 0 and self._qsize() >= self.maxsize:
+                self._get()
+                self.unfinished_tasks -= 1
+                self.dropped += 1
+                self._dropped.inc()
+            entry = [msg]
+            if latest:
+                self._pending[topic] = entry
+            self._put(entry)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+
 class MqttClient(mqtt.Client):
     def __init__(self, host, port, log, topics=[], msg_queue=None):
         assert(isinstance(topics, list))
         super(MqttClient, self).__init__()
         self._log = log
-        self._topics = topics
+        self._topics = list(topics)
         self._msg_queue = msg_queue
+        self._handlers = TopicTrie()
+        self._messages = REGISTRY.counter('mqtt_messages')
+        self._dispatch_sec = REGISTRY.histogram('mqtt_dispatch_sec')
 
         self.on_connect = self._on_connect
         self.on_message = self._on_message
@@ -29,16 +200,119 @@ class MqttClient(mqtt.Client):
         return MqttClient(host, port, log, topics, msg_queue)
 
     def _on_connect(self, client, userdata, flags, rc):
-        self._log.info("Connected with result code " + str(rc))
+        self._log.info('Connected with result code %s', rc)
         for topic in self._topics:
-            self._log.info('Signing up for topic %s' % topic)
+            self._log.info('Signing up for topic %s', topic)
             self.subscribe(topic)
 
     def _on_message(self, client, userdata, msg):
-        self._log.debug('mqtt._on_message() ' +
-                        msg.topic + " " + str(msg.payload))
+        start = timer()
+        self._log.debug('mqtt._on_message() %s %s', msg.topic, msg.payload)
+        self._handlers.dispatch(msg)
         if self._msg_queue:
             self._msg_queue.put(msg)
+        self._messages.inc()
+        self._dispatch_sec.observe(timer() - start)
+
+    def add_topic(self, topic):
+        ''' Subscribe to another topic, now and on every reconnect '''
+        if topic not in self._topics:
+            self._topics.append(topic)
+            self.subscribe(topic)
+
+    def add_handler(self, topic, handler):
+        ''' Subscribe to topic and call handler(msg) for each message on it.
+        Handlers run on the network thread, so they must not block.
+        '''
+        self._handlers.add(topic, handler)
+        self.add_topic(topic)
+
+    def get_message(self, timeout=None):
+        if self._msg_queue:
+            return self._msg_queue.get(block=True, timeout=timeout)
+        return None
+
+
+class MqttHub(object):
+    ''' One MqttClient shared by several components of a process.  Each
+    component gets a HubClient from client(), which takes the same
+    arguments as MqttClient.make so it can stand in for mk_mqtt.  Incoming
+    messages are dispatched by topic to each component's own queue.
+
+    >>> from Queue import Queue
+    >>> class Msg(object):
+    ...     def __init__(self, topic): self.topic = topic
+    >>> hub = MqttHub(client=None, log=None)
+    >>> q1, q2 = Queue(), Queue()
+    >>> hub._routes.add('/motion/#', q1.put)
+    >>> hub._routes.add('/nfc/scan/#', q2.put)
+    >>> hub._routes.add('/motion/status/#', q1.put)
+    >>> hub._on_client_message(Msg('/motion/status/on/'))
+    >>> hub._on_client_message(Msg('/nfc/scan/data/'))
+    >>> q1.qsize(), q2.qsize()
+    (1, 1)
+    '''
+    def __init__(self, client, log):
+        self._client = client
+        self._log = log
+        self._lock = Lock()
+        self._routes = TopicTrie()
+        self._loop_started = False
+
+    @classmethod
+    def make(cls, host, port, log):
+        hub = MqttHub(client=None, log=log)
+        hub._client = MqttClient(host, port, log, msg_queue=hub)
+        return hub
+
+    def client(self, log, topics=[], msg_queue=None):
+        assert(isinstance(topics, list))
+        hc = HubClient(self, msg_queue)
+        if msg_queue is not None:
+            for topic in topics:
+                self.add_handler(topic, msg_queue.put)
+        return hc
+
+    def add_handler(self, topic, handler):
+        self._routes.add(topic, handler)
+        self._client.add_topic(topic)
+
+    def _on_client_message(self, msg):
+        # TopicTrie yields each handler (i.e. each queue) once, as separate
+        # clients with overlapping subscriptions would see it
+        self._routes.dispatch(msg)
+
+    # The shared client treats the hub as its message queue
+    put = _on_client_message
+
+    def loop_start(self):
+        with self._lock:
+            if not self._loop_started:
+                self._client.loop_start()
+                self._loop_started = True
+
+    def publish(self, *args, **kwargs):
+        return self._client.publish(*args, **kwargs)
+
+
+class HubClient(object):
+    ''' A component's view of an MqttHub '''
+    def __init__(self, hub, msg_queue):
+        self._hub = hub
+        self._msg_queue = msg_queue
+
+    def loop_start(self):
+        self._hub.loop_start()
+
+    def loop_forever(self):
+        self._hub.loop_start()
+        Event().wait()
+
+    def publish(self, *args, **kwargs):
+        return self._hub.publish(*args, **kwargs)
+
+    def add_handler(self, topic, handler):
+        self._hub.add_handler(topic, handler)
 
     def get_message(self, timeout=None):
         if self._msg_queue:
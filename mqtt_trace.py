@@ -0,0 +1,292 @@
+"""
+Usage:
+  mqtt_trace [options] dump <trace_file>
+  mqtt_trace [options] stats <trace_file>
+  mqtt_trace [options] replay <trace_file>
+
+Read MQTT traces recorded by 'things2c snoop --record FILE'.
+
+Sub-commands:
+  dump              Print the messages, one "<sec> <topic> [<payload>]" per
+                    line (the text format replay.py reads)
+  stats             Messages and messages/sec per topic
+  replay            Publish the messages to the broker again, paced as
+                    recorded
+
+Options:
+  -h --help           Print usage
+  -f --filter=TOPIC   Only messages matching this topic filter [default: /#]
+  -c --config=FILE    Configuration file for replay
+                      [default: /etc/things2c/things2c.ini]
+  -s --speed=X        Replay speed multiplier [default: 1]
+
+Trace format: a sequence of records, each starting with a kind byte
+(integers little-endian).
+
+  H  header: "T2CT", version (1 byte), start time (double, epoch seconds).
+     Starts every recording, so traces can be appended to.  A writer that
+     runs out of topic ids (or msec) starts a new recording in the file.
+  T  topic: id (2 bytes), length (2 bytes), topic.  Defines the id that
+     messages use for a topic, the first time it is seen.
+  M  message: msec since start (4 bytes, never decreasing), topic id
+     (2 bytes), length (4 bytes), payload.
+
+>>> from StringIO import StringIO
+>>> clock = [1000.0]
+>>> f = StringIO()
+>>> tw = TraceWriter.make(f, now=lambda: clock[0])
+>>> for topic, payload in [('/nfc/scan/', ''), ('/nfc/scan/data/', 'abc'),
+...                        ('/nfc/scan/', ''), ('/motion/detected/', '')]:
+...     clock[0] += 0.5
+...     tw.write(topic, payload)
+>>> tw.flush()
+>>> len(f.getvalue())
+118
+>>> f.seek(0)
+>>> list(read_trace(f))
+... # doctest: +NORMALIZE_WHITESPACE
+[(0.5, '/nfc/scan/', ''), (1.0, '/nfc/scan/data/', 'abc'),
+ (1.5, '/nfc/scan/', ''), (2.0, '/motion/detected/', '')]
+>>> f.seek(0)
+>>> list(read_trace(f, topic_filter='/nfc/scan/#'))[-1]
+(1.5, '/nfc/scan/', '')
+>>> f.seek(0)
+>>> for topic, count, rate in stats(read_trace(f)):
+...     print topic, count, rate
+/motion/detected/ 1 0.5
+/nfc/scan/ 2 1.0
+/nfc/scan/data/ 1 0.5
+
+Past max_topics topics, a new recording starts (and topic ids are reused):
+
+>>> f = StringIO()
+>>> tw = TraceWriter.make(f, now=lambda: clock[0], max_topics=2)
+>>> for topic in ('/a/', '/b/', '/c/', '/a/'):
+...     clock[0] += 0.5
+...     tw.write(topic, '')
+>>> f.seek(0)
+>>> list(read_trace(f))
+[(0.5, '/a/', ''), (1.0, '/b/', ''), (1.5, '/c/', ''), (2.0, '/a/', '')]
+>>> f.getvalue().count('H' + MAGIC)
+2
+
+A trace cut off mid-record (snoop killed) ends at its last complete record,
+and trim() cuts the torn record off, so a recording can be appended:
+
+>>> torn = StringIO(f.getvalue()[:-2])
+>>> list(read_trace(torn))[-1]
+(1.5, '/c/', '')
+>>> trim(torn)
+>>> tw = TraceWriter.make(torn, now=lambda: clock[0])
+>>> clock[0] += 0.5
+>>> tw.write('/d/', 'x')
+>>> torn.seek(0)
+>>> list(read_trace(torn))[-2:]
+[(1.5, '/c/', ''), (2.5, '/d/', 'x')]
+"""
+import struct
+from functools import partial
+
+MAGIC = 'T2CT'
+VERSION = 1
+_header = struct.Struct('<c4sBd')
+_topic = struct.Struct('<cHH')
+_message = struct.Struct('<cIHI')
+MAX_MSEC = 0xffffffff
+
+
+def main(cli, open_trace, out, mk_mqtt, sleep):
+    with open_trace(cli.trace_file) as f:
+        messages = read_trace(f, topic_filter=cli.filter)
+        if cli.dump:
+            for sec, topic, payload in messages:
+                out('%.3f %s%s' % (sec, topic,
+                                   ' %s' % payload if payload else ''))
+        elif cli.stats:
+            for topic, count, rate in stats(messages):
+                out('%-40s %10d %10.2f/sec' % (topic, count, rate))
+        elif cli.replay:
+            replay(messages, mk_mqtt(), sleep, float(cli.speed))
+        else:
+            raise NotImplementedError()
+
+
+def is_trace(f):
+    ''' Whether seekable file f holds a binary trace (f is rewound) '''
+    start = f.read(1 + len(MAGIC))
+    f.seek(0)
+    return start == 'H' + MAGIC
+
+
+class TraceWriter(object):
+    ''' Append messages to a trace file.  Meant to be called from the MQTT
+    network thread only.  Writes go through the file's buffer and are
+    flushed at most every flush_sec.
+    '''
+    def __init__(self, f, now, flush_sec, max_topics):
+        self._f = f
+        self._now = now
+        self._flush_sec = flush_sec
+        self._max_topics = max_topics
+        self._last_flush = now()
+        self._recording(self._last_flush)
+
+    @classmethod
+    def make(cls, f, now, flush_sec=5, max_topics=1 << 16):
+        return TraceWriter(f, now, flush_sec, max_topics)
+
+    def _recording(self, start):
+        ''' Start a new recording: fresh topic ids and msec '''
+        self._start = start
+        self._msec = 0
+        self._topic_ids = dict()
+        self._f.write(_header.pack('H', MAGIC, VERSION, start))
+
+    def write(self, topic, payload):
+        now = self._now()
+        # Wall clock steps backwards (e.g. NTP) don't reorder the trace
+        msec = max(self._msec, int(round((now - self._start) * 1000)))
+        if msec > MAX_MSEC or (topic not in self._topic_ids and
+                               len(self._topic_ids) >= self._max_topics):
+            # Out of ids (2 bytes) or time (4 bytes): roll over in place
+            self._recording(self._start + self._msec / 1000.0)
+            msec = max(0, int(round((now - self._start) * 1000)))
+        self._msec = msec
+        topic_id = self._topic_ids.get(topic)
+        if topic_id is None:
+            topic_id = self._topic_ids[topic] = len(self._topic_ids)
+            self._f.write(_topic.pack('T', topic_id, len(topic)) + topic)
+        self._f.write(_message.pack('M', self._msec, topic_id,
+                                    len(payload)) + payload)
+        if now - self._last_flush >= self._flush_sec:
+            self._f.flush()
+            self._last_flush = now
+
+    def flush(self):
+        self._f.flush()
+        self._last_flush = self._now()
+
+
+class _Torn(Exception):
+    ''' The trace ends part way through a record '''
+    pass
+
+
+def _read(f, n):
+    data = f.read(n)
+    if len(data) < n:
+        raise _Torn()
+    return data
+
+
+def _records(f):
+    ''' (kind, fields, data) for each complete record in f '''
+    structs = dict(H=_header, T=_topic, M=_message)
+    while True:
+        kind = f.read(1)
+        if not kind:
+            return
+        if kind not in structs:
+            raise ValueError('Bad trace record %r' % kind)
+        try:
+            fields = structs[kind].unpack(
+                kind + _read(f, structs[kind].size - 1))[1:]
+            data = _read(f, fields[-1]) if kind != 'H' else ''
+        except _Torn:
+            return
+        yield kind, fields, data
+
+
+def trim(f):
+    ''' Cut a torn last record off trace file f (opened for update), and
+    leave f at the end, ready to append to
+    '''
+    f.seek(0)
+    end = 0
+    for _ in _records(f):
+        end = f.tell()
+    f.seek(end)
+    f.truncate()
+
+
+def read_trace(f, topic_filter='/#'):
+    ''' (sec, topic, payload) for each message in f matching topic_filter,
+    with times relative to the start of the first recording
+    '''
+    from mqtt_client import TopicTrie
+    trie = TopicTrie()
+    trie.add(topic_filter, True)
+    matches = dict()
+    first = None
+    offset = 0
+    topics = dict()
+    for kind, fields, data in _records(f):
+        if kind == 'M':
+            msec, topic_id, _ = fields
+            topic = topics[topic_id]
+            if topic not in matches:
+                matches[topic] = bool(trie.match(topic))
+            if matches[topic]:
+                yield offset + msec / 1000.0, topic, data
+        elif kind == 'T':
+            topics[fields[0]] = data
+        else:
+            magic, version, start = fields
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('Not a version %d trace' % VERSION)
+            first = start if first is None else first
+            offset = start - first
+            topics.clear()
+
+
+def stats(messages):
+    ''' (topic, count, messages/sec) per topic, from the start of the
+    recording to the last message
+    '''
+    counts = dict()
+    duration = 0
+    for sec, topic, payload in messages:
+        counts[topic] = counts.get(topic, 0) + 1
+        duration = sec
+    return [(topic, count, count / duration if duration else 0)
+            for topic, count in sorted(counts.items())]
+
+
+def replay(messages, mqtt, sleep, speed=1):
+    ''' Publish messages through mqtt, paced as recorded (speed times
+    faster)
+    '''
+    last = None
+    for sec, topic, payload in messages:
+        if last is not None and sec > last:
+            sleep((sec - last) / speed)
+        last = sec
+        mqtt.publish(topic, payload)
+
+if __name__ == '__main__':
+    def _tcb_():
+        import logging
+        from attrdict import AttrDict
+        from docopt import docopt
+        from sys import argv
+        from time import sleep
+
+        logging.basicConfig(format='%(asctime)s: %(message)s',
+                            datefmt='%Y.%m.%d %H:%M:%S', level=logging.INFO)
+        cli = AttrDict(dict([(i[0].replace('--', '').strip('<>'), i[1])
+                             for i in docopt(__doc__,
+                                             argv=argv[1:]).items()]))
+
+        def out(line):
+            print line
+
+        def mk_mqtt():
+            from config import Config
+            from mqtt_client import MqttClient
+            broker = Config(open(cli.config)).config.broker
+            return MqttClient.make(broker.host, broker.port,
+                                   log=logging.getLogger(__name__))
+
+        return dict(cli=cli, open_trace=partial(open, mode='rb'), out=out,
+                    mk_mqtt=mk_mqtt, sleep=sleep)
+    main(**_tcb_())
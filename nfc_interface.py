@@ -28,7 +28,7 @@ class NfcInterface(object):
         return NfcInterface(nfc, now, log)
 
     def read(self, timeout=2):
-        self._log.debug('NFC read(), timeout %d' % timeout)
+        self._log.debug('NFC read(), timeout %d', timeout)
 
         queue = Queue()
         started = self._now()
@@ -51,9 +51,36 @@ class NfcInterface(object):
         except Empty:
             data = None
 
-        self._log.debug('NFC read() data: %s' % data)
+        self._log.debug('NFC read() data: %s', data)
         return data
 
+    def sense(self, on_tag, timeout, interval=0.25):
+        ''' Poll for a tag every interval seconds, for up to timeout seconds,
+        keeping the frontend open.  on_tag(data) is called as soon as a tag
+        connects; sense() then returns once the tag is removed (or timeout
+        passes), so a tag left on the reader is read once per call rather than
+        over and over.
+        '''
+        started = self._now()
+
+        def term():
+            return self._now() - started > timeout
+
+        def connected(tag):
+            self._log.debug('NFC sense() connected')
+            on_tag(tag.ndef.message[0].data if tag.ndef else None)
+            # Wait for the tag to be removed
+            return True
+
+        constat = self._clf.connect(rdwr={'on-connect': connected,
+                                          'interval': interval},
+                                    terminate=term)
+        if constat is False:
+            raise IOError('Connect returned False')
+
+    def close(self):
+        self._clf.close()
+
     def write(self, data, timeout=2):
         started = self._now()
 
@@ -70,6 +97,82 @@ class NfcInterface(object):
         msg.text = data
         tag.ndef.message = self._nfc.ndef.Message(msg)
 
+
+class TagDebounce(object):
+    ''' Drop repeated reads of the same tag within hold_sec of the last one
+    let through.  A tag left on the reader still gets through every hold_sec
+    (motionctl needs to keep seeing it).
+
+    >>> clock = [0]
+    >>> td = TagDebounce(now=lambda: clock[0])
+    >>> td.fresh('abc', hold_sec=3), td.fresh('abc', hold_sec=3)
+    (True, False)
+    >>> clock[0] = 2; td.fresh('abc', hold_sec=3)
+    False
+    >>> clock[0] = 3; td.fresh('abc', hold_sec=3), td.fresh('xyz', hold_sec=3)
+    (True, True)
+    >>> td.fresh('abc', hold_sec=3)
+    True
+    '''
+    def __init__(self, now):
+        self._now = now
+        self._data = None
+        self._seen = None
+
+    def fresh(self, data, hold_sec):
+        now = self._now()
+        if data == self._data and now - self._seen < hold_sec:
+            return False
+        self._data, self._seen = data, now
+        return True
+
+
+class NfcRecovery(object):
+    ''' Decide how to recover from consecutive reader failures, escalating
+    through tiers as the failure count (n) grows:
+
+     - every failure: wait backoff_sec * 2^(n-1), capped at backoff_max_sec
+     - n >= reopen_after: also close and reopen the frontend
+     - n >= usb_reset_after: also reset the USB device (if usb_reset_cmd)
+     - n >= reboot_after: reboot
+
+    >>> from attrdict import AttrDict
+    >>> settings = AttrDict(backoff_sec=1, backoff_max_sec=8, reopen_after=3,
+    ...                     usb_reset_after=5, reboot_after=7,
+    ...                     usb_reset_cmd='usbreset')
+    >>> r = NfcRecovery()
+    >>> [r.failed(settings) for i in range(7)]
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [('retry', 1), ('retry', 2), ('reopen', 4), ('reopen', 8),
+     ('usb_reset', 8), ('usb_reset', 8), ('reboot', 8)]
+    >>> r.succeeded(); r.count
+    0
+    >>> settings.usb_reset_cmd = ''
+    >>> [r.failed(settings)[0] for i in range(7)][-3:]
+    ['reopen', 'reopen', 'reboot']
+    '''
+    def __init__(self):
+        self.count = 0
+
+    def succeeded(self):
+        self.count = 0
+
+    def failed(self, settings):
+        ''' Returns (action, seconds to wait before the next attempt) '''
+        self.count += 1
+        n = self.count
+        delay = min(settings.backoff_sec * 2 ** (n - 1),
+                    settings.backoff_max_sec)
+        if n >= settings.reboot_after:
+            action = 'reboot'
+        elif n >= settings.usb_reset_after and settings.usb_reset_cmd:
+            action = 'usb_reset'
+        elif n >= settings.reopen_after:
+            action = 'reopen'
+        else:
+            action = 'retry'
+        return action, delay
+
 if __name__ == '__main__':
     def _tcb_():
         import nfc
@@ -1,4 +1,35 @@
+'''
+Against a local stand-in for api.pushover.net - three identical messages
+are coalesced and the connection is kept alive between sends:
+
+>>> import logging
+>>> from httplib import HTTPConnection
+>>> from time import time, sleep
+>>> from urllib import urlencode
+>>> server = StandInServer.make()
+>>> log = logging.getLogger('doctest')
+>>> pn = PushoverNotify.make(urlencode=urlencode, connection=HTTPConnection,
+...                          user='u', token='t', log=log, host=server.host)
+>>> an = AsyncNotify.make(notifier=pn, log=log, now=time, sleep=sleep,
+...                       coalesce_sec=0.2)
+>>> for msg in ['MOTION', 'MOTION OFF', 'MOTION', 'MOTION']:
+...     an.notify(msg)
+>>> an.flush()
+True
+>>> an.notify('MOTION ON')
+>>> an.flush()
+True
+>>> server.messages
+['MOTION x3', 'MOTION OFF', 'MOTION ON']
+>>> server.connections
+1
+>>> server.close()
+'''
+from collections import OrderedDict
 from functools import partial
+from Queue import Queue, Empty, Full
+from threading import Thread
+from metrics import REGISTRY, timer
 
 
 def main(mk_pn, msg):
@@ -11,27 +42,234 @@ def main(mk_pn, msg):
 
 
 class PushoverNotify(object):
-    def __init__(self, urlencode, connection, user, token, log):
+    def __init__(self, urlencode, connection, user, token, log, host):
         self._log = log
         self._urlencode = urlencode
         self._connection = connection
         self._user = user
         self._token = token
+        self._host = host
+        self._conn = None
+        self._sent = REGISTRY.counter('pushover_sent')
+        self._errors = REGISTRY.counter('pushover_errors')
+        self._notify_sec = REGISTRY.histogram('pushover_notify_sec')
+
+    @classmethod
+    def make(cls, urlencode, connection, user, token, log,
+             host='api.pushover.net:443'):
+        return PushoverNotify(urlencode, connection, user, token, log, host)
+
+    def notify(self, msg):
+        self._log.info('Pushover: %s', msg)
+        body = self._urlencode({'token': self._token,
+                                'user': self._user,
+                                'message': msg})
+        start = timer()
+        # Reuse the connection; if the server has dropped it, reconnect once
+        for attempt in (1, 2):
+            try:
+                if not self._conn:
+                    self._conn = self._connection(self._host)
+                self._conn.request(
+                    'POST', '/1/messages.json', body,
+                    {'Content-type': 'application/x-www-form-urlencoded'})
+                response = self._conn.getresponse()
+                # The whole response must be read before the next request
+                response.read()
+                self._sent.inc()
+                self._notify_sec.observe(timer() - start)
+                return response
+            except Exception:
+                if self._conn:
+                    self._conn.close()
+                self._conn = None
+                if attempt == 2:
+                    self._errors.inc()
+                    raise
+
+
+class TokenBucket(object):
+    ''' Allow rate events per second on average, in bursts of up to burst
+    (rate 0: unlimited)
+
+    >>> clock = [0]
+    >>> tb = TokenBucket(rate=0.5, burst=2, now=lambda: clock[0])
+    >>> tb.take(), tb.take(), tb.take()
+    (0, 0, 2.0)
+    >>> clock[0] += 2
+    >>> tb.take()
+    2.0
+    >>> clock[0] += 10
+    >>> tb.take()
+    0
+    >>> clock[0] += 10
+    >>> tb.take(4)
+    4.0
+    >>> TokenBucket(rate=0, burst=1, now=lambda: 0).take(10)
+    0
+    '''
+    def __init__(self, rate, burst, now):
+        self._rate = rate
+        self._burst = burst
+        self._now = now
+        self._tokens = burst
+        self._last = now()
+
+    def take(self, n=1):
+        ''' Take n tokens; returns how long to wait before using them '''
+        if not self._rate:
+            return 0
+        now = self._now()
+        self._tokens = min(self._burst,
+                           self._tokens + (now - self._last) * self._rate)
+        self._last = now
+        self._tokens -= n
+        return 0 if self._tokens >= 0 else -self._tokens / self._rate
+
+
+class AsyncNotify(object):
+    ''' Send notifications from a background thread, so callers never block
+    on the network.  The queue is bounded (messages are dropped when it is
+    full), sends are rate limited by a token bucket, and identical messages
+    queued within coalesce_sec of each other are sent once as "MSG xN".
+    '''
+    def __init__(self, notifier, log, now, sleep, maxsize, rate, burst,
+                 coalesce_sec):
+        self._notifier = notifier
+        self._log = log
+        self._now = now
+        self._sleep = sleep
+        self._q = Queue(maxsize=maxsize)
+        self._bucket = TokenBucket(rate=rate, burst=burst, now=now)
+        self._coalesce_sec = coalesce_sec
+        self.dropped = 0
+        self._dropped = REGISTRY.counter('notify_dropped')
+        self._queue_depth = REGISTRY.gauge('notify_queue_depth')
+        t = Thread(target=self._run, name='AsyncNotify')
+        t.daemon = True
+        t.start()
 
     @classmethod
-    def make(cls, urlencode, connection, user, token, log):
-        return PushoverNotify(urlencode, connection, user, token, log)
+    def make(cls, notifier, log, now, sleep, maxsize=50, rate=0.5, burst=5,
+             coalesce_sec=2):
+        return AsyncNotify(notifier, log, now, sleep, maxsize, rate, burst,
+                           coalesce_sec)
 
     def notify(self, msg):
-        self._log.info('Pushover: %s' % msg)
-        c = self._connection('api.pushover.net:443')
-        c.request('POST', '/1/messages.json',
-                  self._urlencode({
-                      'token': self._token,
-                      'user': self._user,
-                      'message': msg}),
-                  {'Content-type': 'application/x-www-form-urlencoded'})
-        return c.getresponse()
+        try:
+            self._q.put_nowait(msg)
+        except Full:
+            self.dropped += 1
+            self._dropped.inc()
+            self._log.error('AsyncNotify queue full, dropped: %s', msg)
+
+    def flush(self, timeout=None):
+        ''' Wait until everything queued so far has been sent, or for at
+        most timeout seconds; whether it was sent
+
+        >>> from time import time, sleep
+        >>> class Stuck(object):
+        ...     def notify(self, msg): sleep(0.5)
+        >>> an = AsyncNotify.make(notifier=Stuck(), log=None, now=time,
+        ...                       sleep=sleep, coalesce_sec=0)
+        >>> an.notify('network down')
+        >>> an.flush(timeout=0.1), an.flush()
+        (False, True)
+        '''
+        if timeout is None:
+            self._q.join()
+            return True
+        deadline = self._now() + timeout
+        with self._q.all_tasks_done:
+            while self._q.unfinished_tasks:
+                remaining = deadline - self._now()
+                if remaining <= 0:
+                    return False
+                self._q.all_tasks_done.wait(remaining)
+        return True
+
+    def _collect(self):
+        ''' The next message plus everything else queued during the
+        coalescing window, counted by message text (in arrival order)
+        '''
+        pending = OrderedDict([(self._q.get(), 1)])
+        deadline = self._now() + self._coalesce_sec
+        while True:
+            remaining = deadline - self._now()
+            if remaining <= 0:
+                break
+            try:
+                msg = self._q.get(timeout=remaining)
+                pending[msg] = pending.get(msg, 0) + 1
+            except Empty:
+                break
+        return pending
+
+    def _run(self):
+        while True:
+            pending = self._collect()
+            self._queue_depth.set(self._q.qsize())
+            for msg, n in pending.items():
+                wait = self._bucket.take()
+                if wait:
+                    self._sleep(wait)
+                try:
+                    self._notifier.notify(msg if n == 1
+                                          else '%s x%d' % (msg, n))
+                except Exception, e:
+                    self._log.error('AsyncNotify send failed: %s', e)
+            for i in range(sum(pending.values())):
+                self._q.task_done()
+
+
+class StandInServer(object):
+    ''' A local HTTP server standing in for api.pushover.net in tests.  It
+    records the messages posted and how many connections were opened.
+    '''
+    def __init__(self):
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+        from urlparse import parse_qs
+        server = self
+        self.messages = list()
+        self.connections = 0
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                server.connections += 1
+                BaseHTTPRequestHandler.setup(self)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                server.messages.append(parse_qs(body)['message'][0])
+                reply = '{"status":1}'
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+
+            def log_message(self, *args):
+                pass
+
+        # Threaded, so a kept-alive connection doesn't hold up shutdown()
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self._httpd = Server(('127.0.0.1', 0), Handler)
+        self.host = '127.0.0.1:%d' % self._httpd.server_port
+        t = Thread(target=self._httpd.serve_forever)
+        t.daemon = True
+        t.start()
+
+    @classmethod
+    def make(cls):
+        return StandInServer()
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
 
 if __name__ == '__main__':
     def _tcb_():
@@ -46,5 +284,3 @@ if __name__ == '__main__':
                                   user=argv[2]),
                     msg=argv[3])
     main(**_tcb_())
-
-    
\ No newline at end of file
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+'''
+Local publish relay: a Unix datagram socket that a running things2c process
+listens on, so event hooks can hand over topic/payload pairs without
+starting things2c.  Each datagram is "<topic name>\\0<payload>".
+
+Run directly, this module is the tiny client used by motion's hooks:
+
+  things2c-relay [--socket=PATH] <topic> [<payload>]
+
+Keep the imports here to the standard library's bare minimum - the point
+is that the client starts in a few milliseconds.  If nothing is listening,
+the client falls back to 'things2c publish'.
+
+Anyone who can write to the socket can publish, so it lives in a directory
+of its own (deployment/things2c.tmpfiles) and is only group writable: the
+hooks' user (motion) must share the socket's group.  A stale socket is
+replaced; anything else in its place is left alone and stops the relay.
+
+>>> import os, tempfile
+>>> path = os.path.join(tempfile.mkdtemp(), 'relay.sock')
+>>> got = []
+>>> rs = RelayServer.make(path=path, log=None,
+...                       handler=lambda t, p: got.append((t, p)))
+>>> send(path, 'motion_detected')
+>>> send(path, 'motion_filesync_queue', '/var/lib/motion/a.jpg')
+>>> rs.handle_one(); rs.handle_one()
+>>> got
+[('motion_detected', ''), ('motion_filesync_queue', '/var/lib/motion/a.jpg')]
+>>> oct(os.stat(path).st_mode & 0777)
+'0660'
+>>> rs.close()
+>>> open(path, 'w').close()
+>>> RelayServer.make(path=path, log=None, handler=None)
+... # doctest: +ELLIPSIS
+Traceback (most recent call last):
+...
+RelayError: ... exists and isn't a socket
+>>> os.remove(path)
+>>> send(path, 'motion_detected')
+Traceback (most recent call last):
+...
+error: [Errno 2] No such file or directory
+>>> os.rmdir(os.path.dirname(path))
+'''
+import socket
+
+DEFAULT_SOCKET = '/run/things2c/relay.sock'
+MAX_DATAGRAM = 65536
+
+
+class RelayError(Exception):
+    pass
+
+
+def send(path, topic, payload=''):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        s.sendto('%s\0%s' % (topic, payload), path)
+    finally:
+        s.close()
+
+
+class RelayServer(object):
+    def __init__(self, path, log, handler):
+        from os import chmod, lstat, remove
+        from stat import S_ISSOCK
+        self._path = path
+        self._log = log
+        self._handler = handler
+        try:
+            mode = lstat(path).st_mode
+        except OSError:
+            mode = None
+        if mode is not None:
+            if not S_ISSOCK(mode):
+                raise RelayError("%s exists and isn't a socket" % path)
+            # Left over from a relay that didn't shut down cleanly
+            remove(path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(path)
+        # Hooks run as other users (e.g. motion) in the socket's group
+        chmod(path, 0660)
+
+    @classmethod
+    def make(cls, path, log, handler):
+        return RelayServer(path, log, handler)
+
+    def handle_one(self):
+        data = self._sock.recv(MAX_DATAGRAM)
+        topic, _, payload = data.partition('\0')
+        self._handler(topic, payload)
+
+    def serve_forever(self):
+        while True:
+            try:
+                self.handle_one()
+            except Exception, e:
+                self._log.error('RelayServer: %s', e)
+
+    def close(self):
+        from os import remove
+        self._sock.close()
+        remove(self._path)
+
+
+def client(argv):
+    args = list(argv)
+    path = DEFAULT_SOCKET
+    for arg in list(args):
+        if arg.startswith('--socket='):
+            path = arg.split('=', 1)[1]
+            args.remove(arg)
+    if len(args) not in (1, 2):
+        raise SystemExit(
+            'Usage: things2c-relay [--socket=PATH] <topic> [<payload>]')
+    try:
+        send(path, *args)
+    except socket.error:
+        # No relay listening - publish the slow way
+        from os import execvp
+        execvp('things2c', ['things2c', 'publish', '--topic', args[0]] +
+               (['--payload=%s' % args[1]] if len(args) > 1 else []))
+
+if __name__ == '__main__':
+    from sys import argv
+    client(argv[1:])
@@ -0,0 +1,394 @@
+"""
+Usage:
+  replay [options] (motionctl | blinkctl | watchdog | filemanager)
+
+Replays a topic/payload trace into one of the things2c consumer loops,
+running it against an in-memory broker on a fake clock, and reports
+per-message latency percentiles and throughput.  Latency is the (real)
+time from handing a message to the consumer until it blocks again.
+
+Options:
+  -h --help         Print usage
+  -c --config=FILE  Configuration file [default: things2c.ini.example]
+  -t --trace=FILE   Trace to replay: recorded by 'things2c snoop --record',
+                    or text, one "<sec> <topic> [<payload>]" per line
+                    (default: a synthetic trace)
+  -n --number=N     Messages in the synthetic trace [default: 10000]
+  -r --rate=R       Messages per (simulated) second on average (default:
+                    10 for the synthetic trace; a recorded trace keeps its
+                    own timing, or is scaled to this rate)
+  -s --speed=X      Replay speed multiplier, as in mqtt_trace [default: 1]
+"""
+import datetime as dt
+from collections import Counter
+from functools import partial
+from Queue import Empty
+from mqtt_client import TopicTrie
+
+# Simulated time 0
+EPOCH = dt.datetime(2016, 1, 1, 0, 0, 0)
+
+
+def main(cli, cfg, open_trace, timer, report, report_count):
+    if cli.trace:
+        from mqtt_trace import is_trace, read_trace
+        with open_trace(cli.trace) as f:
+            trace = list(read_trace(f)) if is_trace(f) else load_trace(f)
+        if cli.rate:
+            trace = at_rate(trace, float(cli.rate))
+    else:
+        trace = synthetic(cfg, int(cli.number), float(cli.rate or 10))
+    trace = scale(trace, float(cli.speed))
+    consumer = [c for c in CONSUMERS if cli[c]][0]
+    result = run(consumer, cfg, trace, timer)
+
+    report_count('%s messages' % consumer, len(result.latencies))
+    for p in (50, 90, 99, 100):
+        report('latency p%d' % p, percentile(result.latencies, p))
+    report_count('throughput (msg/sec)',
+                 len(result.latencies) / result.elapsed
+                 if result.elapsed else 0)
+    for topic, n in sorted(result.published.items()):
+        report_count('published %s' % topic, n)
+    for msg, n in sorted(result.notified.items()):
+        report_count('notified %s' % msg, n)
+
+
+class Done(Exception):
+    ''' The trace has been replayed '''
+    pass
+
+
+class ReplayMsg(object):
+    def __init__(self, topic, payload=''):
+        self.topic = topic
+        self.payload = payload
+
+
+def load_trace(f):
+    ''' [(sec, topic, payload)] from "<sec> <topic> [<payload>]" lines
+
+    >>> from StringIO import StringIO
+    >>> load_trace(StringIO('0.5 /nfc/scan/\\n1 /motion/filesync/queue/ a b'))
+    [(0.5, '/nfc/scan/', ''), (1.0, '/motion/filesync/queue/', 'a b')]
+    '''
+    trace = list()
+    for line in f:
+        fields = line.strip().split(None, 2)
+        if fields:
+            trace.append((float(fields[0]), fields[1],
+                          fields[2] if len(fields) > 2 else ''))
+    return trace
+
+
+def scale(trace, speed):
+    ''' trace played speed times as fast
+
+    >>> scale([(1.0, '/a/', ''), (3.0, '/b/', 'x')], 2)
+    [(0.5, '/a/', ''), (1.5, '/b/', 'x')]
+    '''
+    return [(t / speed, topic, payload) for t, topic, payload in trace]
+
+
+def at_rate(trace, rate):
+    ''' trace scaled to rate messages per second on average, keeping its
+    bursts and gaps in proportion
+
+    >>> at_rate([(10.0, '/a/', ''), (11.0, '/b/', ''), (14.0, '/c/', '')], 1)
+    [(5.0, '/a/', ''), (5.5, '/b/', ''), (7.0, '/c/', '')]
+    '''
+    times = [t for t, _, _ in trace]
+    span = max(times) - min(times) if times else 0
+    if not span:
+        return trace
+    return scale(trace, rate * span / (len(trace) - 1))
+
+
+def synthetic(cfg, number, rate):
+    ''' A trace cycling through the traffic the consumers see, with valid
+    scan data for the configured authorized_id
+    '''
+    from things2c import dt_salted_hash
+    topics = cfg.get_topics()
+    secret = cfg.config.motionctl.authorized_id
+    trace = list()
+    for i in range(number):
+        t = i / rate
+        token = dt_salted_hash(secret, EPOCH + dt.timedelta(seconds=int(t)))
+        trace.append((t,) + [(topics.nfc_scan, ''),
+                             (topics.nfc_scan_data, token),
+                             (topics.motion_detected, ''),
+                             (topics.motion_event_start, ''),
+                             (topics.motion_filesync_queue, 'f%d.jpg' % i),
+                             (topics.motion_status_off, '')][i % 6])
+    return trace
+
+
+def percentile(values, p):
+    '''
+    >>> percentile(range(1, 101), 50), percentile(range(1, 101), 99)
+    (50, 99)
+    >>> percentile([], 50)
+    0
+    '''
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[max(int(round(p / 100.0 * len(values))) - 1, 0)]
+
+
+class Replay(object):
+    ''' The in-memory broker and fake clock a consumer runs against.
+    Trace messages are delivered once simulated time reaches them; the
+    clock only moves when the consumer blocks (queue get with a timeout,
+    sleep), so a run is deterministic.
+    '''
+    def __init__(self, trace, timer):
+        self._trace = sorted(trace, key=lambda m: m[0])
+        self._next = 0
+        self._timer = timer
+        self._subscriptions = TopicTrie()
+        self._handlers = TopicTrie()
+        self._handed = list()
+        self.t = 0
+        self.latencies = list()
+        self.published = Counter()
+
+    def now(self, as_datetime=False):
+        if as_datetime:
+            return EPOCH + dt.timedelta(seconds=self.t)
+        return self.t
+
+    def sleep(self, sec):
+        self.block()
+        if self._next >= len(self._trace):
+            raise Done()
+        self.t += sec
+        self.deliver()
+
+    def block(self):
+        ''' The consumer is about to wait - it is done with what it has '''
+        done = self._timer()
+        self.latencies.extend(done - start for start in self._handed)
+        del self._handed[:]
+
+    def handed(self):
+        self._handed.append(self._timer())
+
+    def next_due(self):
+        if self._next < len(self._trace):
+            return self._trace[self._next][0]
+        return None
+
+    def deliver(self):
+        ''' Deliver the trace messages that are due '''
+        while self._next < len(self._trace) and \
+                self._trace[self._next][0] <= self.t:
+            _, topic, payload = self._trace[self._next]
+            self._next += 1
+            msg = ReplayMsg(topic, payload)
+            for handler in self._handlers.match(topic):
+                self.handed()
+                handler(msg)
+                self.block()
+            for queue in self._subscriptions.match(topic):
+                queue.put(msg)
+
+    def client(self, log, topics=[], msg_queue=None):
+        for topic in topics:
+            self._subscriptions.add(topic, msg_queue)
+        return ReplayClient(self)
+
+    def queue(self):
+        return FakeQueue(self)
+
+    def loop_forever(self):
+        while self._next < len(self._trace):
+            self.t = self.next_due()
+            self.deliver()
+        raise Done()
+
+    def add_handler(self, topic, handler):
+        self._handlers.add(topic, handler)
+
+    def publish(self, topic, payload=None):
+        self.published[topic] += 1
+
+
+class ReplayClient(object):
+    ''' Stands in for MqttClient '''
+    def __init__(self, replay):
+        self._replay = replay
+
+    def loop_start(self):
+        pass
+
+    def loop_forever(self):
+        self._replay.loop_forever()
+
+    def add_handler(self, topic, handler):
+        self._replay.add_handler(topic, handler)
+
+    def publish(self, topic, payload=None):
+        self._replay.publish(topic, payload)
+
+
+class FakeQueue(object):
+    ''' Stands in for Queue.Queue: waiting advances the fake clock to the
+    next trace message (or by the timeout) instead of blocking
+
+    >>> r = Replay([(1, '/a/', 'x'), (5, '/a/', 'y')], timer=lambda: 0)
+    >>> q = r.queue()
+    >>> c = r.client(log=None, topics=['/a/'], msg_queue=q)
+    >>> q.empty(), q.get(timeout=2).payload, r.t
+    (True, 'x', 1)
+    >>> q.get(timeout=2)
+    Traceback (most recent call last):
+    ...
+    Empty
+    >>> r.t, q.get().payload, r.t
+    (3, 'y', 5)
+    >>> q.get()
+    Traceback (most recent call last):
+    ...
+    Done
+    '''
+    def __init__(self, replay):
+        self._replay = replay
+        self._items = list()
+
+    def put(self, msg):
+        self._items.append(msg)
+
+    def qsize(self):
+        return len(self._items)
+
+    def empty(self):
+        self._replay.deliver()
+        return not self._items
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def get(self, block=True, timeout=None):
+        r = self._replay
+        r.deliver()
+        if not self._items and block:
+            r.block()
+            deadline = None if timeout is None else r.t + timeout
+            # Other consumers' messages don't end the wait
+            while not self._items:
+                due = r.next_due()
+                if due is None:
+                    raise Done()
+                if deadline is not None and due > deadline:
+                    r.t = deadline
+                    break
+                r.t = max(r.t, due)
+                r.deliver()
+        if not self._items:
+            raise Empty()
+        r.handed()
+        return self._items.pop(0)
+
+
+class ReplayResult(object):
+    def __init__(self, latencies, elapsed, published, notified):
+        self.latencies = latencies
+        self.elapsed = elapsed
+        self.published = published
+        self.notified = notified
+
+
+def run(consumer, cfg, trace, timer):
+    ''' Replay trace into consumer (one of CONSUMERS)
+
+    >>> from config import Config
+    >>> from pkg_resources import resource_stream
+    >>> cfg = Config(resource_stream(__name__, 'things2c.ini.example'))
+    >>> trace = synthetic(cfg, number=600, rate=10)
+    >>> r = run('motionctl', cfg, trace, timer=lambda: 0)
+    >>> len(r.latencies), sorted(r.notified.items())
+    (300, [('MOTION OFF', 1), ('Motion', 100)])
+    >>> sorted(r.published.items())
+    [('/info/', 100), ('/motion/status/off/', 12), ('/motion/status/on/', 1)]
+    >>> r = run('filemanager', cfg, trace, timer=lambda: 0)
+    >>> len(r.latencies), dict(r.notified)
+    (200, {'cancel': 100, 'queue': 100})
+    '''
+    import things2c
+    replay = Replay(trace, timer)
+    notified = Counter()
+    motion = [True]
+
+    class Notify(object):
+        def notify(self, msg):
+            notified[msg] += 1
+
+    class Fmq(object):
+        # Counted in notified: the file manager's side effects
+        def queue(self, **kwargs):
+            notified['queue'] += 1
+
+        def cancel(self):
+            notified['cancel'] += 1
+
+    def motion_to(on):
+        motion[0] = on
+
+    args = dict(cli=None, cfg=cfg, mk_mqtt=replay.client,
+                mk_queue=replay.queue)
+    mk_notify = lambda log: Notify()
+    consumers = dict(
+        motionctl=partial(things2c.motionctl, now=replay.now,
+                          is_motion_on=lambda: motion[0],
+                          motion_on=partial(motion_to, True),
+                          motion_off=partial(motion_to, False),
+                          mk_notify=mk_notify, **args),
+        blinkctl=partial(things2c.blinkctl, blink=lambda pattern: None,
+                         sleep=replay.sleep, now=replay.now, **args),
+        watchdog=partial(things2c.watchdog, mk_notify=mk_notify, **args),
+        filemanager=partial(things2c.filemanger, cli=None, cfg=cfg,
+                            mk_mqtt=replay.client,
+                            mk_fmq=lambda **kwargs: Fmq(), upload=None,
+                            delete=None, now=replay.now,
+                            mk_journal=lambda: None,
+                            mk_index=lambda: None))
+    started = timer()
+    try:
+        consumers[consumer]()
+    except Done:
+        pass
+    return ReplayResult(replay.latencies, timer() - started,
+                        replay.published, notified)
+
+CONSUMERS = ['motionctl', 'blinkctl', 'watchdog', 'filemanager']
+
+if __name__ == '__main__':
+    def _tcb_():
+        import logging
+        from attrdict import AttrDict
+        from docopt import docopt
+        from sys import argv
+        from time import time
+        from config import Config, ConfigError
+
+        # Keep debug output of the code under test out of the measurement
+        logging.disable(logging.DEBUG)
+        cli = AttrDict(dict([(i[0].replace('--', '').strip('<>'), i[1])
+                             for i in docopt(__doc__,
+                                             argv=argv[1:]).items()]))
+        try:
+            cfg = Config(open(cli.config))
+        except ConfigError, e:
+            raise SystemExit('%s: %s' % (cli.config, e))
+
+        def report(name, sec):
+            print '%-40s %10.2f usec' % (name, sec * 1e6)
+
+        def report_count(name, count):
+            print '%-40s %10.2f' % (name, count)
+
+        return dict(cli=cli, cfg=cfg, open_trace=partial(open, mode='rb'),
+                    timer=time, report=report, report_count=report_count)
+    main(**_tcb_())
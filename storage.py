@@ -0,0 +1,228 @@
+'''
+Storage backends the file manager uploads to, and FanOut, which uploads a
+batch to all of them at once.  A backend has a name (its destination in
+the file index) and upload(fullpaths, timeout_sec), which raises on failure
+(or after timeout_sec).
+
+>>> from time import time, sleep
+>>> class Log(object):
+...     def error(self, msg, *args): print msg % args
+>>> cmds = []
+>>> def system(cmd):
+...     # The first rsync fails
+...     cmds.append(cmd)
+...     return int(cmd.count('rsync') and
+...                 len([c for c in cmds if 'rsync' in c]) == 1)
+>>> s3 = S3Storage.make('s3://bucket/', system, chunk_size_mb=8,
+...                     max_kb_per_sec=100, resume=True)
+>>> local = LocalStorage.make('backup:/srv/', system, max_kb_per_sec=0)
+>>> fo = FanOut.make([local, s3], index=None, log=Log(), now=time,
+...                  sleep=sleep, retries=1, retry_sec=0, timeout_sec=60)
+>>> fo.upload(['/st/a.jpg', '/st/b.avi'])
+local upload failed (attempt 1): exit status 1
+>>> print '\\n'.join(sorted(cmds))  # doctest: +NORMALIZE_WHITESPACE
+timeout 59 rsync -t --partial /st/a.jpg /st/b.avi backup:/srv/
+timeout 59 rsync -t --partial /st/a.jpg /st/b.avi backup:/srv/
+timeout 59 s3cmd put --continue-put --multipart-chunk-size-mb=8
+    --limit-rate=100k /st/a.jpg /st/b.avi s3://bucket/
+
+Each attempt only gets what's left of timeout_sec.  A backend that is slow
+doesn't hold up the others, but the batch fails, and the backend's thread,
+left to finish, records nothing:
+
+>>> class Index(object):
+...     def refresh(self, fullpath): pass
+...     def is_done(self, name, dest): return False
+...     def mark(self, name, dest, status): print 'mark', name, dest, status
+>>> class Slow(object):
+...     name = 'slow'
+...     def upload(self, fullpaths, timeout_sec): sleep(0.3)
+>>> fo = FanOut.make([Slow()], index=Index(), log=Log(), now=time,
+...                  sleep=sleep, retries=0, retry_sec=0, timeout_sec=0.1)
+>>> fo.upload(['/st/c.jpg'])
+Traceback (most recent call last):
+...
+StorageError: upload to slow failed
+>>> sleep(0.4)
+'''
+from os import path as ospath
+from threading import Event, Lock, Thread
+from metrics import REGISTRY
+
+
+class StorageError(Exception):
+    pass
+
+
+def _run(system, cmd, timeout_sec):
+    status = system('timeout %d %s' % (max(timeout_sec, 1), cmd))
+    if status != 0:
+        raise StorageError('exit status %s' % status)
+
+
+class S3Storage(object):
+    ''' s3cmd; with resume (the file index knows what the bucket has), put
+    rather than sync, continuing unfinished multipart uploads
+    '''
+    name = 's3'
+
+    def __init__(self, dest, system, chunk_size_mb, max_kb_per_sec, resume):
+        self._dest = dest
+        self._system = system
+        self._chunk_size_mb = chunk_size_mb
+        self._max_kb_per_sec = max_kb_per_sec
+        self._resume = resume
+
+    @classmethod
+    def make(cls, dest, system, chunk_size_mb=8, max_kb_per_sec=0,
+             resume=False):
+        return S3Storage(dest, system, chunk_size_mb, max_kb_per_sec, resume)
+
+    def upload(self, fullpaths, timeout_sec):
+        _run(self._system,
+             's3cmd %(op)s '
+             '--multipart-chunk-size-mb=%(chunk)d %(limit)s%(fullpaths)s '
+             '%(dest)s'
+             % dict(op='put --continue-put' if self._resume else 'sync',
+                    chunk=self._chunk_size_mb,
+                    limit=('--limit-rate=%dk ' % self._max_kb_per_sec
+                           if self._max_kb_per_sec else ''),
+                    fullpaths=' '.join(fullpaths), dest=self._dest),
+             timeout_sec)
+
+
+class WebDavStorage(object):
+    ''' ownCloud (WebDAV) through a chunked_upload.ChunkedUploader '''
+    name = 'owncloud'
+
+    def __init__(self, uploader, now, subdir):
+        self._uploader = uploader
+        self._now = now
+        self._subdir = subdir
+
+    @classmethod
+    def make(cls, uploader, now, subdir=''):
+        return WebDavStorage(uploader, now, subdir)
+
+    def upload(self, fullpaths, timeout_sec):
+        deadline = self._now() + timeout_sec
+        for fullpath in fullpaths:
+            self._uploader.put(ospath.join(self._subdir,
+                                           ospath.basename(fullpath)),
+                               fullpath, deadline=deadline)
+
+
+class LocalStorage(object):
+    ''' rsync to a directory, local or remote (host:path); partial files
+    are kept, so an interrupted transfer resumes
+    '''
+    name = 'local'
+
+    def __init__(self, dest, system, max_kb_per_sec):
+        self._dest = dest
+        self._system = system
+        self._max_kb_per_sec = max_kb_per_sec
+
+    @classmethod
+    def make(cls, dest, system, max_kb_per_sec=0):
+        return LocalStorage(dest, system, max_kb_per_sec)
+
+    def upload(self, fullpaths, timeout_sec):
+        _run(self._system,
+             'rsync -t --partial %(limit)s%(fullpaths)s %(dest)s'
+             % dict(limit=('--bwlimit=%d ' % self._max_kb_per_sec
+                           if self._max_kb_per_sec else ''),
+                    fullpaths=' '.join(fullpaths), dest=self._dest),
+             timeout_sec)
+
+
+class FanOut(object):
+    ''' Upload a batch to every backend concurrently, so a batch takes as
+    long as the slowest destination rather than the sum of them.  Each
+    backend is retried (backing off from retry_sec) on its own, every
+    attempt limited to what's left of timeout_sec; backends still going
+    after that are reported failed, and their thread, left to finish,
+    neither retries nor records its result.  With a file index, files a
+    backend already has are skipped and results are recorded.
+    '''
+    def __init__(self, backends, index, log, now, sleep, retries, retry_sec,
+                 timeout_sec):
+        self._backends = backends
+        self._index = index
+        self._log = log
+        self._now = now
+        self._sleep = sleep
+        self._retries = retries
+        self._retry_sec = retry_sec
+        self._timeout_sec = timeout_sec
+
+    @classmethod
+    def make(cls, backends, index, log, now, sleep, retries=2, retry_sec=10,
+             timeout_sec=3600):
+        return FanOut(backends, index, log, now, sleep, retries, retry_sec,
+                      timeout_sec)
+
+    def upload(self, fullpaths):
+        if self._index:
+            for fullpath in fullpaths:
+                self._index.refresh(fullpath)
+        results = dict()
+        lock = Lock()
+        abandoned = Event()
+        deadline = self._now() + self._timeout_sec
+        threads = [Thread(target=self._upload_to,
+                          args=(backend, fullpaths, deadline, results, lock,
+                                abandoned),
+                          name='Storage-%s' % backend.name)
+                   for backend in self._backends]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join(max(deadline - self._now(), 0))
+        with lock:
+            # Backends still going are on their own now: the file manager
+            # queues the batch again, so they mustn't record anything
+            abandoned.set()
+            failed = [b.name for b in self._backends
+                      if not results.get(b.name)]
+        if failed:
+            raise StorageError('upload to %s failed' % ', '.join(failed))
+
+    def _upload_to(self, backend, fullpaths, deadline, results, lock,
+                   abandoned):
+        from file_index import DONE, FAILED
+        index = self._index
+        todo = [fp for fp in fullpaths
+                if not index or
+                not index.is_done(ospath.basename(fp), backend.name)]
+        upload_sec = REGISTRY.histogram('storage_%s_sec' % backend.name)
+        errors = REGISTRY.counter('storage_%s_errors' % backend.name)
+        status = FAILED
+        for attempt in range(self._retries + 1):
+            left = deadline - self._now()
+            if abandoned.is_set() or left <= 0:
+                break
+            try:
+                if todo:
+                    upload_sec.timed(backend.upload, todo, left)
+                status = DONE
+                break
+            except Exception, e:
+                errors.inc()
+                self._log.error('%s upload failed (attempt %d): %s',
+                                backend.name, attempt + 1, e)
+                backoff = self._retry_sec * 2 ** attempt
+                if (attempt < self._retries and
+                        self._now() + backoff < deadline):
+                    self._sleep(backoff)
+                else:
+                    break
+        with lock:
+            if abandoned.is_set():
+                return
+            results[backend.name] = status == DONE
+            if index:
+                for fullpath in todo:
+                    index.mark(ospath.basename(fullpath), backend.name,
+                               status)
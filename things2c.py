@@ -8,6 +8,8 @@ Usage:
   things2c [options] publish
   things2c [options] snoop
   things2c [options] filemanager
+  things2c [options] relay
+  things2c [options] hub <component>...
   things2c version
 
 Sub-commands:
@@ -19,6 +21,10 @@ Sub-commands:
   publish           Publish topic/payload to MQ
   snoop             Output all MQTT traffic
   filemanager       Upload/delete video files
+  relay             Publish topic/payload pairs sent to the local relay
+                    socket (see relay.py)
+  hub               Run several daemons over one MQTT connection, e.g.
+                    hub motionctl filemanager watchdog
   version           Display version and exit
 
 Options:
@@ -28,6 +34,8 @@ Options:
   -t --topic=TOPIC  Topic to publish
   -p --payload=PL   Payload for publish
   -e --encode       Encode payload
+  --record=FILE     snoop: append a binary trace to FILE instead of logging
+                    (read it with mqtt_trace.py)
 """
 import logging
 from attrdict import AttrDict
@@ -35,7 +43,14 @@ from hashlib import sha1
 from collections import defaultdict
 from datetime import timedelta
 from functools import partial
+from os import path as ospath
 from Queue import Queue, Empty
+from threading import Thread
+from deadlines import Deadlines
+from file_manager import stored_size
+from metrics import REGISTRY, publish as publish_metrics, timer
+from nfc_interface import NfcRecovery, TagDebounce
+from token_verifier import TokenVerifier
 
 logging.basicConfig(format='%(asctime)s: %(message)s',
                     datefmt='%Y.%m.%d %H:%M:%S', level=logging.INFO)
@@ -43,31 +58,61 @@ logging.basicConfig(format='%(asctime)s: %(message)s',
 log = logging.getLogger(__name__)
 
 
-def main(cli, cfg, mk_mqtt, mk_notify, mk_nfc, sleep, blink, now,
-         is_motion_on, motion_on, motion_off, reboot, mk_fmq,
-         upload, delete, mk_mplog):
+# Long-running sub-commands - these can also be run together by hub
+DAEMONS = ['nfc_scan', 'motionctl', 'watchdog', 'blinkctl', 'filemanager',
+           'relay']
+
+# How long a reboot waits for its notification to go out
+REBOOT_NOTIFY_SEC = 30
+
+
+def main(cli, cfg, mk_mqtt, mk_hub, mk_notify, mk_nfc, sleep, blink, now,
+         is_motion_on, motion_on, motion_off, reboot, usb_reset, mk_fmq,
+         upload, delete, mk_relay, relay_send, mk_trace, mk_queue,
+         mk_journal, mk_index):
     if cli.verbose:
         log.setLevel(logging.DEBUG)
 
-    if cli.nfc_scan:
-        nfc_scan(cli, cfg, mk_mqtt, mk_nfc, sleep, mk_notify, reboot, now)
-    elif cli.motionctl:
-        motionctl(cli, cfg, mk_mqtt, sleep, now, is_motion_on,
-                  motion_on, motion_off, mk_notify)
-    elif cli.watchdog:
-        watchdog(cli, cfg, mk_mqtt, mk_notify)
-    elif cli.blinkctl:
-        blinkctl(cli, cfg, mk_mqtt, blink, sleep, now)
+    def daemon(name, mk_mqtt):
+        return dict(
+            nfc_scan=partial(nfc_scan, cli, cfg, mk_mqtt, mk_nfc, sleep,
+                             mk_notify, reboot, usb_reset, now),
+            motionctl=partial(motionctl, cli, cfg, mk_mqtt, now,
+                              is_motion_on, motion_on, motion_off,
+                              mk_notify,
+                              mk_queue=partial(mk_queue, name)),
+            watchdog=partial(watchdog, cli, cfg, mk_mqtt, mk_notify,
+                             mk_queue=partial(mk_queue, name)),
+            blinkctl=partial(blinkctl, cli, cfg, mk_mqtt, blink, sleep, now,
+                             mk_queue=partial(mk_queue, name)),
+            filemanager=partial(filemanger, cli, cfg, mk_mqtt, mk_fmq,
+                                upload, delete, now, mk_journal, mk_index),
+            relay=partial(relay, cli, cfg, mk_mqtt, mk_relay))[name]
+
+    daemons = [d for d in DAEMONS if cli[d]]
+    if daemons:
+        clients = list()
+
+        def daemon_mqtt(**kwargs):
+            # Metrics go out over the daemon's own (first) connection
+            client = mk_mqtt(**kwargs)
+            if not clients:
+                start_metrics(daemons[0], cfg, client, sleep)
+            clients.append(client)
+            return client
+        daemon(daemons[0], daemon_mqtt)()
+    elif cli.hub:
+        hub(cli.component, daemon, cfg, mk_hub, sleep)
     elif cli.notify:
         notify = mk_notify(log=log)
         notify.notify(cli.notify_text)
+        notify.flush()
     elif cli.publish:
-        valid_topics = [vn for vn in
-                        cfg.get_topics().keys() if not vn.endswith('_all')]
+        topics = cfg.get_topics()
+        valid_topics = publishable(topics)
         if not cli.topic or cli.topic not in valid_topics:
-            log.error('Valid topics are:\n%s' % '\n'.join(valid_topics))
+            log.error('Valid topics are:\n%s', '\n'.join(valid_topics))
         else:
-            mqtt = mk_mqtt(log=log)
             if cli.payload:
                 if cli.encode:
                     payload = dt_salted_hash(cli.payload,
@@ -76,16 +121,99 @@ def main(cli, cfg, mk_mqtt, mk_notify, mk_nfc, sleep, blink, now,
                     payload = cli.payload
             else:
                 payload = ''
-            mqtt.publish(cfg.get_topics()[cli.topic], payload)
+            try:
+                # Hand over to a running relay rather than connecting
+                relay_send(cli.topic, payload)
+            except Exception, e:
+                log.debug('Relay unavailable (%s), publishing directly', e)
+                mk_mqtt(log=log).publish(topics[cli.topic], payload)
     elif cli.snoop:
-        snoop(cli, mk_mqtt)
-    elif cli.filemanager:
-        filemanger(cli, cfg, mk_mqtt, mk_fmq, upload, delete, mk_mplog, now)
+        snoop(cli, mk_mqtt, mk_trace)
     else:
         raise NotImplementedError()
 
 
-def snoop(cli, mk_mqtt):
+def hub(components, daemon, cfg, mk_hub, sleep):
+    unknown = [c for c in components if c not in DAEMONS]
+    if unknown:
+        log.error('Valid hub components are:\n%s', '\n'.join(DAEMONS))
+        return
+
+    mqtt_hub = mk_hub(log=log)
+    start_metrics('hub', cfg, mqtt_hub, sleep)
+    threads = [Thread(target=daemon(c, mqtt_hub.client), name=c)
+               for c in sorted(set(components), key=components.index)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    # If any component dies, exit so supervisor restarts the whole hub
+    while all(t.is_alive() for t in threads):
+        sleep(1)
+    log.error('hub() %s exited - stopping',
+              ', '.join(t.name for t in threads if not t.is_alive()))
+    raise SystemExit(1)
+
+
+def start_metrics(name, cfg, mqtt, sleep):
+    ''' Publish this process's metrics to /metrics/<name>/ through mqtt (a
+    client the caller runs) in the background, every [metrics] publish_sec
+    '''
+    interval = cfg.config.metrics.publish_sec
+    if interval:
+        t = Thread(target=publish_metrics, name='metrics',
+                   args=(name, REGISTRY, mqtt, cfg.get_topics(), sleep,
+                         interval))
+        t.daemon = True
+        t.start()
+
+
+def publishable(topics):
+    ''' Topic names that may be published (the '_all' ones are wildcards;
+    metrics are the daemons' own)
+
+    >>> publishable({'info': '/info/', 'motion_all': '/motion/#',
+    ...              'metrics': '/metrics/'})
+    ['info']
+    '''
+    return [vn for vn in topics.keys()
+            if not vn.endswith('_all') and vn != 'metrics']
+
+
+def relay(cli, cfg, mk_mqtt, mk_relay):
+    topics = cfg.get_topics()
+    valid_topics = set(publishable(topics))
+    mqtt = mk_mqtt(log=log)
+    mqtt.loop_start()
+
+    def on_datagram(topic, payload):
+        if topic in valid_topics:
+            mqtt.publish(topics[topic], payload)
+        else:
+            log.error('relay() ignoring unknown topic %s', topic)
+
+    mk_relay(log=log, handler=on_datagram).serve_forever()
+
+
+def snoop(cli, mk_mqtt, mk_trace):
+    if cli.record:
+        from signal import signal, SIGTERM
+
+        def on_term(signum, frame):
+            # Unwind (e.g. supervisor stopping us) so the trace is flushed
+            raise SystemExit(0)
+        signal(SIGTERM, on_term)
+        # Written straight from the network thread: no queue, no logging
+        trace = mk_trace(cli.record)
+        mqtt = mk_mqtt(log=log)
+        mqtt.add_handler('/#', lambda msg: trace.write(msg.topic,
+                                                      msg.payload))
+        try:
+            mqtt.loop_forever()
+        finally:
+            trace.flush()
+        return
+
     q = Queue()
     mqtt = mk_mqtt(log=log, topics=['/#'], msg_queue=q)
     mqtt.loop_start()
@@ -93,8 +221,10 @@ def snoop(cli, mk_mqtt):
         try:
             msg = q.get(block=True, timeout=1)
             if msg:
-                log.info('%s%s' % (msg.topic, ', %s' %
-                                   msg.payload if msg.payload else ''))
+                if msg.payload:
+                    log.info('%s, %s', msg.topic, msg.payload)
+                else:
+                    log.info('%s', msg.topic)
         except Empty:
             pass
 
@@ -106,7 +236,7 @@ def dt_salted_hash(data, dt):
     '35a86879588c32b6299f562ebb70d7926c6e4bc8'
     '''
     h = sha1(dt.strftime('%Y%m%d%H%M%S') + data).hexdigest()
-    log.debug('data: %s, dt: %s, hash: %s' % (data, dt, h))
+    log.debug('data: %s, dt: %s, hash: %s', data, dt, h)
     return h
 
 
@@ -129,91 +259,254 @@ def authorized(candidate, secret, now, window_sec=30):
                          for t in range(1, window_sec + 1)])
                  for t2 in sublist]:
         key_hash = dt_salted_hash(secret, time)
-        log.debug('authorized() dt: %s, candidate: %s, key_hash: %s' %
-                  (time, candidate, key_hash))
+        log.debug('authorized() dt: %s, candidate: %s, key_hash: %s',
+                  time, candidate, key_hash)
         if key_hash == candidate:
             return True
     return False
 
 
-def filemanger(cli, cfg, mk_mqtt, mk_fmq, upload, delete, mk_mplog, now):
-    mplog = mk_mplog()
-    if cli.verbose:
-        mplog.setLevel(logging.DEBUG)
-
-    fmq = mk_fmq(log=mplog, mk_mqtt=mk_mqtt)
-
-    q = Queue()
-    mqtt = mk_mqtt(log=log, topics=[cfg.get_topics().motion_filesync_all,
-                                    cfg.get_topics().nfc_scan_all],
-                   msg_queue=q)
-    mqtt.loop_start()
-    while True:
-        try:
-            msg = q.get(timeout=0.5)
-            log.debug('filemanager() got %s, %s' % (msg.topic, msg.payload))
-            if(msg.topic == cfg.get_topics().nfc_scan_data and
-               authorized(msg.payload, cfg.config.motionctl.authorized_id,
-                          now)):
-                log.debug('filemanger() got authorized scan')
-                fmq.cancel()
-            elif msg.topic == cfg.get_topics().motion_filesync_queue:
-                fmq.queue(upload=partial(upload, filename=msg.payload),
-                          delete=partial(delete, filename=msg.payload),
-                          timeout=int(cfg.config.filemanager.filesync_delay),
-                          start_msg=(cfg.get_topics().motion_filesync_start,
-                                     msg.payload),
-                          end_msg=(cfg.get_topics().motion_filesync_end,
-                                   msg.payload),
-                          cancel_msg=(cfg.get_topics().motion_filesync_cancel,
-                                      msg.payload))
-        except Empty:
-            pass
-        #  Avoid zombies
-        fmq._join_all(timeout=0)
-
-
-def motionctl(cli, cfg, mk_mqtt, sleep, now, is_motion_on,
-              motion_on, motion_off, mk_notify):
-    q = Queue()
-    mqtt = mk_mqtt(log=log, topics=[cfg.get_topics().nfc_scan_all],
+def upload_dests(fmc):
+    ''' The destinations configured in [filemanager] fmc '''
+    return ((['s3'] if fmc.s3_dest else []) +
+            (['owncloud'] if fmc.oc_url else []) +
+            (['local'] if fmc.local_dest else []))
+
+
+def filemanger(cli, cfg, mk_mqtt, mk_fmq, upload, delete, now, mk_journal,
+               mk_index):
+    ''' Queue files for upload after filesync_delay; an authorized scan
+    cancels the ones still waiting.  With a journal, what was pending
+    before a restart (motion's full paths) is queued again first, and with
+    an index, stored files that were never uploaded are queued after:
+
+    >>> import datetime as dt, os, tempfile
+    >>> from StringIO import StringIO
+    >>> from config import Config
+    >>> from file_index import FileIndex
+    >>> from journal import Journal
+    >>> from pkg_resources import resource_stream
+    >>> store = tempfile.mkdtemp()
+    >>> for name in ('a.jpg', 'b.avi', 'c.jpg'):
+    ...     open(os.path.join(store, name), 'w').close()
+    >>> ini = resource_stream(__name__, 'things2c.ini.example').read()
+    >>> cfg = Config(StringIO(ini.replace('/var/lib/motion/storage', store)))
+    >>> path = os.path.join(tempfile.mkdtemp(), 'filesync.journal')
+    >>> j = Journal.make(path, sync_sec=0)
+    >>> a, b = os.path.join(store, 'a.jpg'), os.path.join(store, 'b.avi')
+    >>> j.queued(a, due=100); j.cancel(a); j.queued(b, 130)
+    >>> j.close()
+    >>> class Mqtt(object):
+    ...     handlers = dict()
+    ...     def add_handler(self, topic, handler):
+    ...         self.handlers[topic] = handler
+    ...     def loop_forever(self):
+    ...         pass
+    >>> class Fmq(object):
+    ...     def queue(self, filename, timeout, cancelled=False,
+    ...               cancellable=True, **msgs):
+    ...         print 'queue', os.path.basename(filename), timeout,
+    ...         print 'cancelled' if cancelled else cancellable
+    ...     def cancel(self):
+    ...         print 'cancel'
+    >>> class Msg(object):
+    ...     def __init__(self, payload):
+    ...         self.payload = payload
+    >>> def now(as_datetime=False):
+    ...     return dt.datetime(2016, 1, 1) if as_datetime else 100
+    >>> mqtt = Mqtt()
+    >>> index = FileIndex.make(':memory:')
+    >>> def run():
+    ...     filemanger(None, cfg, lambda log: mqtt, lambda **kwargs: Fmq(),
+    ...                upload=None, delete=None, now=now,
+    ...                mk_journal=lambda: Journal.make(path, sync_sec=0),
+    ...                mk_index=lambda: index)
+
+    A new index takes c.jpg as uploaded, but not the journal's files:
+
+    >>> run()
+    queue a.jpg 0 cancelled
+    queue b.avi 30.0 True
+    >>> index.pending(upload_dests(cfg.config.filemanager))
+    ['a.jpg', 'b.avi']
+    >>> topics = cfg.get_topics()
+    >>> mqtt.handlers[topics.nfc_scan_data](Msg(dt_salted_hash(
+    ...     cfg.config.motionctl.authorized_id, dt.datetime(2016, 1, 1))))
+    cancel
+
+    Next time, a file stored while the file manager was down is queued
+    (once, and not cancellable):
+
+    >>> open(os.path.join(store, 'd.jpg'), 'w').close()
+    >>> run()
+    queue a.jpg 0 cancelled
+    queue b.avi 30.0 True
+    queue d.jpg 30.0 False
+    >>> index.close()
+    >>> for name in os.listdir(store):
+    ...     os.remove(os.path.join(store, name))
+    >>> os.rmdir(store)
+    >>> os.remove(path); os.rmdir(os.path.dirname(path))
+    '''
+    topics = cfg.get_topics()
+    verifier = TokenVerifier.make(secret=cfg.config.motionctl.authorized_id,
+                                  now=now, hash_fn=dt_salted_hash)
+
+    auth_sec = REGISTRY.histogram('filemanager_auth_sec')
+    queued = REGISTRY.counter('filemanager_queued')
+    cancels = REGISTRY.counter('filemanager_cancels')
+    upload_sec = REGISTRY.histogram('filemanager_upload_sec')
+    uploaded = REGISTRY.counter('filemanager_uploaded_files')
+
+    def timed_upload(filenames):
+        upload_sec.timed(upload, filenames)
+        uploaded.inc(len(filenames))
+
+    # Both handlers only take a lock and push to the file manager's heap,
+    # so they run directly on the MQTT network thread
+    mqtt = mk_mqtt(log=log)
+    journal = mk_journal()
+    fmc = cfg.config.filemanager
+    fmq = mk_fmq(log=log, mqtt=mqtt, upload=timed_upload, delete=delete,
+                 workers=fmc.workers, batch_window=fmc.batch_window_sec,
+                 journal=journal,
+                 size=lambda filename: stored_size(
+                     cfg.config.filemanager.filestore_path, filename),
+                 batch_bytes=int(fmc.batch_max_mb * (1 << 20)),
+                 large_bytes=int(fmc.large_file_mb * (1 << 20)),
+                 large_workers=fmc.large_workers,
+                 retries=fmc.batch_retries, retry_sec=fmc.batch_retry_sec)
+
+    def queue(filename, timeout, **kwargs):
+        fmq.queue(filename=filename, timeout=timeout,
+                  start_msg=(topics.motion_filesync_start, filename),
+                  end_msg=(topics.motion_filesync_end, filename),
+                  cancel_msg=(topics.motion_filesync_cancel, filename),
+                  **kwargs)
+
+    restored = set()
+    if journal:
+        # Pick up where the last run left off: files cancelled before the
+        # restart are still cancelled, the rest keep their due times
+        cancelled, pending = journal.load()
+        for filename in cancelled:
+            queue(filename, 0, cancelled=True)
+        for filename, due, cancellable in pending:
+            queue(filename, max(due - now(), 0), cancellable=cancellable)
+        # The index (like upload) goes by name: journaled files are
+        # motion's full paths
+        restored.update(ospath.basename(filename) for filename in
+                        cancelled + [filename for filename, _, _ in pending])
+        log.info('filemanager() restored %d cancels, %d uploads',
+                 len(cancelled), len(pending))
+
+    index = mk_index()
+    if index:
+        # Files that never got a queue message (or were stored while the
+        # file manager was down) - only new or changed files are hashed
+        seeding = index.is_empty()
+        index.scan(fmc.filestore_path)
+        if seeding:
+            # A store synced before there was an index: take what's there
+            # as uploaded rather than send it all again
+            index.seed(upload_dests(fmc), exclude=restored)
+        missed = [f for f in index.pending(upload_dests(fmc))
+                  if f not in restored]
+        # Not fresh motion events, so a scan doesn't cancel them
+        for filename in missed:
+            queue(filename, fmc.filesync_delay, cancellable=False)
+        log.info('filemanager() reconciled %d unsynced files', len(missed))
+
+    def on_scan_data(msg):
+        verifier.rekey(cfg.config.motionctl.authorized_id)
+        if auth_sec.timed(verifier.authorized, msg.payload):
+            log.debug('filemanger() got authorized scan')
+            cancels.inc()
+            fmq.cancel()
+
+    def on_filesync_queue(msg):
+        log.debug('filemanager() got %s, %s', msg.topic, msg.payload)
+        queued.inc()
+        queue(msg.payload, cfg.config.filemanager.filesync_delay)
+
+    mqtt.add_handler(topics.nfc_scan_data, on_scan_data)
+    mqtt.add_handler(topics.motion_filesync_queue, on_filesync_queue)
+    mqtt.loop_forever()
+
+
+def motionctl(cli, cfg, mk_mqtt, now, is_motion_on,
+              motion_on, motion_off, mk_notify, mk_queue=Queue):
+    topics = cfg.get_topics()
+    q = mk_queue()
+    mqtt = mk_mqtt(log=log, topics=[topics.nfc_scan_all,
+                                    topics.motion_event_start],
                    msg_queue=q)
     notify = mk_notify(log=log)
+    verifier = TokenVerifier.make(secret=cfg.config.motionctl.authorized_id,
+                                  now=now, hash_fn=dt_salted_hash)
     mqtt.loop_start()
 
+    # Block on the queue until a message arrives or the next deadline:
+    #  - status: re-check motion and publish its status (proc_poll_sleep)
+    #  - motion_on: the scan or auth timeout expires while motion is off
+    deadlines = Deadlines()
+    deadlines.set('status', now())
     last_update = now()
     last_auth = None
+    motion = is_motion_on()
+
+    messages = REGISTRY.counter('motionctl_messages')
+    queue_depth = REGISTRY.gauge('motionctl_queue_depth')
+    loop_sec = REGISTRY.histogram('motionctl_loop_sec')
+    auth_sec = REGISTRY.histogram('motionctl_auth_sec')
     while True:
         try:
-            msg = q.get_nowait()
-            last_update = now()
-            log.debug('motionctl() got %s, %s' % (msg.topic, msg.payload))
-            if(msg.topic == cfg.get_topics().nfc_scan_data and
-               authorized(msg.payload, cfg.config.motionctl.authorized_id,
-                          now)):
-                mqtt.publish(cfg.get_topics().info, 'Authorized scan data')
+            msg = q.get(block=True, timeout=deadlines.timeout(now()))
+        except Empty:
+            msg = None
+        started = timer()
+        if msg:
+            messages.inc()
+            queue_depth.set(q.qsize())
+            log.debug('motionctl() got %s, %s', msg.topic, msg.payload)
+            verifier.rekey(cfg.config.motionctl.authorized_id)
+            if msg.topic == topics.motion_event_start:
+                notify.notify('Motion')
+            else:
+                last_update = now()
+            if(msg.topic == topics.nfc_scan_data and
+               auth_sec.timed(verifier.authorized, msg.payload)):
+                mqtt.publish(topics.info, 'Authorized scan data')
                 last_auth = now()
                 if is_motion_on():
                     motion_off()
                     notify.notify('MOTION OFF')
+                    motion = False
+                    deadlines.set('status', now())
 
-        except Empty:
-            log.debug('motionctl() queue is empty')
-
-        if(((now() - last_update >
-             float(cfg.config.motionctl.scan_timeout_sec)) or
-            ((not last_auth) or now() - last_auth >
-             float(cfg.config.motionctl.auth_timeout_sec))) and
-           not is_motion_on()):
-            log.debug('motionctl() Update/auth timeout exceeded '
-                      'and motion not on - turning on.')
-            motion_on()
-            notify.notify('MOTION ON')
-
-        mqtt.publish(cfg.get_topics().motion_status_on if is_motion_on()
-                     else cfg.get_topics().motion_status_off)
-        if q.empty():
-            sleep(float(cfg.config.motionctl.proc_poll_sleep))
+        if motion:
+            deadlines.cancel('motion_on')
+        else:
+            scan_due = last_update + cfg.config.motionctl.scan_timeout_sec
+            auth_due = (last_auth + cfg.config.motionctl.auth_timeout_sec
+                        if last_auth is not None else now())
+            deadlines.set('motion_on', min(scan_due, auth_due))
+
+        for name in deadlines.pop_due(now()):
+            if name == 'motion_on' and not is_motion_on():
+                log.debug('motionctl() Update/auth timeout exceeded '
+                          'and motion not on - turning on.')
+                motion_on()
+                notify.notify('MOTION ON')
+                motion = True
+                deadlines.set('status', now())
+            elif name == 'status':
+                motion = is_motion_on()
+                mqtt.publish(topics.motion_status_on if motion
+                             else topics.motion_status_off)
+                deadlines.set('status', now() +
+                              cfg.config.motionctl.proc_poll_sleep)
+        loop_sec.observe(timer() - started)
 
 
 def rgbcnvt(rgb):
@@ -238,35 +531,19 @@ def mkpattern(colors, msec=0.4):
             if colors else None)
 
 
-def blinkctl(cli, cfg, mk_mqtt, blink, sleep, now):
-    q = Queue()
-    mqtt = mk_mqtt(log=log, topics=[cfg.get_topics().motion_all],
+def blinkctl(cli, cfg, mk_mqtt, blink, sleep, now, mk_queue=Queue):
+    topics = cfg.get_topics()
+    q = mk_queue()
+    mqtt = mk_mqtt(log=log, topics=[topics.motion_all],
                    msg_queue=q)
     mqtt.loop_start()
 
     last_seen_topics = defaultdict(lambda: None)
 
     def seen_recently(topic):
-        return (last_seen_topics[topic] and
+        return (last_seen_topics[topic] is not None and
                 (now() - last_seen_topics[topic] <
-                 float(cfg.config.blink.recent_status_sec)))
-
-    def topic_to_color(topic):
-        t2c = dict([(cfg.get_topics().motion_status_on,
-                     cfg.config.blink.motion_on_color),
-                    (cfg.get_topics().motion_status_off,
-                     cfg.config.blink.motion_off_color),
-                    (cfg.get_topics().motion_detected,
-                     cfg.config.blink.motion_detected_color),
-                    (cfg.get_topics().motion_filesync_start,
-                     cfg.config.blink.motion_filesync_start_color),
-                    (cfg.get_topics().motion_filesync_end,
-                     cfg.config.blink.motion_filesync_end_color),
-                    (cfg.get_topics().motion_filesync_cancel,
-                     cfg.config.blink.motion_filesync_cancel_color)])
-        if topic in t2c.keys():
-            return t2c[topic]
-        return None
+                 cfg.config.blink.recent_status_sec))
 
     while True:
         # Get all the messages pending - keep track of when we found them
@@ -278,71 +555,112 @@ def blinkctl(cli, cfg, mk_mqtt, blink, sleep, now):
                 pass
 
         # If motion is currently off, blink recent status
-        if(seen_recently(cfg.get_topics().motion_status_off)):
+        if(seen_recently(topics.motion_status_off)):
+            topic_colors = cfg.get_topic_colors()
             colors = list()
             for topic, last_seen in last_seen_topics.items():
-                if(last_seen and (now() - last_seen) <
-                   float(cfg.config.blink.show_status_sec)):
-                    colors.append(topic_to_color(topic))
+                if(last_seen is not None and (now() - last_seen) <
+                   cfg.config.blink.show_status_sec):
+                    colors.append(topic_colors.get(topic))
             if colors:
                 blink(pattern=mkpattern(
                     colors=(sorted([c for c in colors if c])) +
                     ['0x00,0x00,0x00']))
-        sleep(float(cfg.config.blink.sec_between_blinks))
+        sleep(cfg.config.blink.sec_between_blinks)
 
 
 def nfc_scan(cli, cfg, mk_mqtt, mk_nfc, sleep, mk_notify, reboot,
-             now, padlen=3):
+             usb_reset, now, padlen=3):
+    topics = cfg.get_topics()
     nfc = None
     mqtt = mk_mqtt(log=log)
     notify = mk_notify(log=log)
 
-    fail_count = 0
+    debounce = TagDebounce(now=now)
+    # In continuous mode the heartbeat is on its own timer, not the reads
+    deadlines = Deadlines()
+    deadlines.set('heartbeat', now())
+    read_sec = REGISTRY.histogram('nfc_scan_read_sec')
+    failures = REGISTRY.counter('nfc_scan_failures')
+    tags = REGISTRY.counter('nfc_scan_tags')
+
+    def on_tag(data):
+        log.debug('nfc_scan() data: %s', data)
+        if data and len(data) > padlen and \
+           debounce.fresh(data, cfg.config.nfc.debounce_sec):
+            tags.inc()
+            mqtt.publish(topics.nfc_scan_data,
+                         dt_salted_hash(data[padlen:],
+                         now(as_datetime=True)))
+
+    recovery = NfcRecovery()
     while True:
-        log.debug('nfc_scan()')
-        mqtt.publish(cfg.get_topics().nfc_scan)
+        nfcc = cfg.config.nfc
+        continuous = nfcc.mode == 'continuous'
+        if not continuous or deadlines.pop_due(now()):
+            log.debug('nfc_scan()')
+            mqtt.publish(topics.nfc_scan)
+            deadlines.set('heartbeat', now() + nfcc.heartbeat_sec)
         try:
             if not nfc:
                 nfc = mk_nfc(log=log)
-            data = nfc.read()
-            fail_count = 0
-            log.debug('nfc_scan() data: %s' % data)
-            if data and len(data) > padlen:
-                mqtt.publish(cfg.get_topics().nfc_scan_data,
-                             dt_salted_hash(data[padlen:],
-                             now(as_datetime=True)))
+            if continuous:
+                nfc.sense(on_tag, timeout=deadlines.timeout(now()),
+                          interval=nfcc.poll_interval)
+            else:
+                on_tag(read_sec.timed(nfc.read))
+            recovery.succeeded()
         except Exception, e:
-            fail_count += 1
-            msg = 'nfc_scan() failed! Count is %d' % fail_count
+            failures.inc()
+            action, delay = recovery.failed(nfcc)
+            msg = 'nfc_scan() failed! Count is %d' % recovery.count
             log.error(msg)
             log.error(str(e))
-            mqtt.publish(cfg.get_topics().info, msg)
-            #  TODO: Make fail_count configurable
-            if fail_count >= 30:
+            mqtt.publish(topics.info, msg)
+            if action != 'retry' and nfc:
+                # Drop the frontend so the next attempt opens a fresh one
+                try:
+                    nfc.close()
+                except Exception, e:
+                    log.error('nfc_scan() close failed: %s', e)
+                nfc = None
+            if action == 'usb_reset':
+                log.error('nfc_scan() resetting the reader')
+                mqtt.publish(topics.info, 'nfc_scan() resetting the reader')
+                usb_reset(nfcc.usb_reset_cmd)
+            elif action == 'reboot':
                 msg = 'nfc_scan() scanner is stuck - rebooting!'
                 log.error(msg)
-                mqtt.publish(cfg.get_topics().info, msg)
+                mqtt.publish(topics.info, msg)
                 notify.notify(msg)
+                # Notifications are sent in the background: get this one
+                # out before going down, unless the network is gone too
+                if not notify.flush(timeout=REBOOT_NOTIFY_SEC):
+                    log.error('nfc_scan() rebooting without notifying')
                 reboot()
-        log.debug('nfc_scan() sleeping for %s' %
-                  cfg.config.nfc.scan_poll_sleep)
-        sleep(float(cfg.config.nfc.scan_poll_sleep))
-
-
-def watchdog(cli, cfg, mk_mqtt, mk_notify):
-    q = Queue()
-    client = mk_mqtt(log=log, topics=[cfg.get_topics().motion_status_all],
+            log.debug('nfc_scan() %s, backing off for %s', action, delay)
+            sleep(delay)
+            continue
+        if not continuous:
+            log.debug('nfc_scan() sleeping for %s', nfcc.scan_poll_sleep)
+            sleep(nfcc.scan_poll_sleep)
+
+
+def watchdog(cli, cfg, mk_mqtt, mk_notify, mk_queue=Queue):
+    topics = cfg.get_topics()
+    q = mk_queue()
+    client = mk_mqtt(log=log, topics=[topics.motion_status_all],
                      msg_queue=q)
     notify = mk_notify(log=log)
     client.loop_start()
 
-    notifications = int(cfg.config.watchdog.notification_count)
+    notifications = cfg.config.watchdog.notification_count
     while True:
         try:
             msg = q.get(block=True,
-                        timeout=float(cfg.config.watchdog.timeout_sec))
-            log.debug('%s %s' % (msg.topic, msg.payload))
-            notifications = int(cfg.config.watchdog.notification_count)
+                        timeout=cfg.config.watchdog.timeout_sec)
+            log.debug('%s %s', msg.topic, msg.payload)
+            notifications = cfg.config.watchdog.notification_count
         except Empty:
             log.info('Watchdog!')
             if notifications:
@@ -356,22 +674,23 @@ if __name__ == '__main__':
                          for i in docopt(__doc__, argv=argv[1:]).items()]))
 
     def _tcb_():
-        import nfc
+        # Heavier dependencies (nfc, paho, httplib, sqlite3...) are only
+        # imported by the factories below, when a sub-command needs them -
+        # publish and notify shouldn't pay for nfc_scan's imports
         from datetime import datetime
-        from multiprocessing import log_to_stderr
         from os import system, path as ospath, remove
         from time import time, sleep
-        from config import Config
-        from file_manager import FileManagerQueue
-        from httplib import HTTPSConnection
-        from mqtt_client import MqttClient
-        from nfc_interface import NfcInterface
-        from owncloud import Client as ocClient
-        from pushover_notify import PushoverNotify
-        from urllib import urlencode
-
-        with open(cli.config, 'rb') as cfgin:
-            cfg = Config(cfgin)
+        from config import Config, ConfigError
+        from relay import send as relay_send
+
+        try:
+            cfg = Config.watch(cli.config, now=time, log=log)
+        except ConfigError, e:
+            raise SystemExit('%s: %s' % (cli.config, e))
+
+        if cfg.config.logging.queue_size:
+            from async_log import install
+            install(logging.getLogger(), cfg.config.logging.queue_size)
 
         def now(as_datetime=False):
             if as_datetime:
@@ -382,67 +701,177 @@ if __name__ == '__main__':
             system('blink1-tool --playpattern %(pattern)s > /dev/null'
                    % dict(pattern=pattern))
 
+        def mk_mqtt(**kwargs):
+            from mqtt_client import MqttClient
+            return MqttClient.make(cfg.config.broker.host,
+                                   cfg.config.broker.port, **kwargs)
+
+        def mk_hub(**kwargs):
+            from mqtt_client import MqttHub
+            return MqttHub.make(cfg.config.broker.host,
+                                cfg.config.broker.port, **kwargs)
+
+        def mk_nfc(**kwargs):
+            import nfc
+            from nfc_interface import NfcInterface
+            return NfcInterface.make(nfc=nfc, now=now, **kwargs)
+
+        def mk_fmq(**kwargs):
+            from file_manager import FileManagerQueue
+            return FileManagerQueue.make(**kwargs)
+
+        def mk_relay(**kwargs):
+            from relay import RelayServer
+            return RelayServer.make(path=cfg.config.relay.socket_path,
+                                    **kwargs)
+
+        def mk_queue(name):
+            # Bounded, so a stalled consumer can't grow without limit
+            from mqtt_client import MessageQueue
+            qc = cfg.config.queues
+            return MessageQueue.make(name=name, maxsize=qc.maxsize,
+                                     latest_topics=qc.latest_topics)
+
+        def mk_journal():
+            fmc = cfg.config.filemanager
+            if not fmc.journal_path:
+                return None
+            from journal import Journal
+            return Journal.make(fmc.journal_path,
+                                sync_sec=fmc.journal_sync_sec)
+
+        indexes = list()
+
+        def mk_index():
+            # Shared by the daemon's startup scan and upload()
+            fmc = cfg.config.filemanager
+            if not fmc.index_path:
+                return None
+            if not indexes:
+                from file_index import FileIndex
+                indexes.append(FileIndex.make(fmc.index_path))
+            return indexes[0]
+
+        def mk_trace(path):
+            from mqtt_trace import TraceWriter, trim
+            if ospath.exists(path):
+                # A recording that was killed may end in a torn record
+                with open(path, 'r+b') as f:
+                    trim(f)
+            return TraceWriter.make(open(path, 'ab', 1 << 16), now=time)
+
+        motion_states = list()
+
+        def motion_state():
+            if not motion_states:
+                from motion_state import MotionState
+                motion_states.append(MotionState.make(
+                    pidfile=cfg.config.motionctl.motion_pidfile, now=time,
+                    cache_sec=cfg.config.motionctl.state_cache_sec))
+            return motion_states[0]
+
         def is_motion_on():
-            if system('pgrep -a motion > /dev/null') == 0:
-                return True
-            return False
+            return motion_state().is_on()
 
         def motion_on():
             system('sudo supervisorctl start motion')
+            motion_state().invalidate()
 
         def motion_off():
             system('sudo supervisorctl stop motion')
+            motion_state().invalidate()
 
         def reboot():
             system('sudo /sbin/reboot')
 
-        def upload(filename, path, s3_dest, oc_url, oc_user,
-                   oc_password, oc_subdir):
-            fullpath = ospath.join(path, ospath.split(filename)[1])
-            if ospath.isfile(fullpath):
-                if s3_dest:
-                    cmd = ('s3cmd sync %(fullpath)s %(s3_dest)s'
-                           % dict(fullpath=fullpath, s3_dest=s3_dest))
-                    system(cmd)
-                if oc_url:
-                    oc = ocClient(oc_url)
-                    oc.login(oc_user, oc_password)
-                    fn = ospath.split(fullpath)[-1:][0]
-                    oc.put_file(ospath.join(oc_subdir) if oc_subdir else fn,
-                                fullpath)
-
-        def delete(filename, path):
-            fullpath = ospath.join(path, ospath.split(filename)[1])
+        def usb_reset(cmd):
+            system(cmd)
+
+        def mk_storage():
+            # Settings are read per batch so configuration reloads apply
+            from httplib import HTTPConnection, HTTPSConnection
+            from storage import FanOut, LocalStorage, S3Storage, WebDavStorage
+            fmc = cfg.config.filemanager
+            index = mk_index()
+            backends = list()
+            if fmc.s3_dest:
+                backends.append(S3Storage.make(
+                    fmc.s3_dest, system, chunk_size_mb=fmc.chunk_size_mb,
+                    max_kb_per_sec=fmc.max_kb_per_sec, resume=bool(index)))
+            if fmc.oc_url:
+                from chunked_upload import ChunkedUploader
+                connection = (HTTPSConnection
+                              if fmc.oc_url.startswith('https:')
+                              else HTTPConnection)
+                backends.append(WebDavStorage.make(
+                    ChunkedUploader.make(
+                        url=fmc.oc_url, user=fmc.oc_user,
+                        password=fmc.oc_password,
+                        connection=connection,
+                        checkpoint_dir=fmc.checkpoint_dir, now=time,
+                        sleep=sleep, chunk_size=fmc.chunk_size_mb << 20,
+                        parts=fmc.upload_parts,
+                        rate=fmc.max_kb_per_sec * 1024),
+                    now=time, subdir=fmc.oc_subdir))
+            if fmc.local_dest:
+                backends.append(LocalStorage.make(
+                    fmc.local_dest, system,
+                    max_kb_per_sec=fmc.max_kb_per_sec))
+            return FanOut.make(backends, index=index, log=log, now=time,
+                               sleep=sleep, retries=fmc.retries,
+                               retry_sec=fmc.retry_sec,
+                               timeout_sec=fmc.timeout_sec)
+
+        def upload(filenames):
+            fmc = cfg.config.filemanager
+            # One transfer per destination for the whole batch
+            fullpaths = [fp for fp in
+                         [ospath.join(fmc.filestore_path,
+                                      ospath.split(f)[1])
+                          for f in filenames]
+                         if ospath.isfile(fp)]
+            if fullpaths:
+                mk_storage().upload(fullpaths)
+
+        notifiers = list()
+
+        def mk_notify(log):
+            # One background sender (and connection) per process
+            if not notifiers:
+                from httplib import HTTPSConnection
+                from pushover_notify import AsyncNotify, PushoverNotify
+                from urllib import urlencode
+                pc = cfg.config.pushover
+                notifiers.append(AsyncNotify.make(
+                    notifier=PushoverNotify.make(urlencode=urlencode,
+                                                 connection=HTTPSConnection,
+                                                 token=pc.token, user=pc.user,
+                                                 log=log),
+                    log=log, now=time, sleep=sleep, maxsize=pc.queue_size,
+                    rate=pc.rate_per_min / 60.0, burst=pc.burst,
+                    coalesce_sec=pc.coalesce_sec))
+            return notifiers[0]
+
+        def delete(filename):
+            fullpath = ospath.join(cfg.config.filemanager.filestore_path,
+                                   ospath.split(filename)[1])
             if ospath.isfile(fullpath):
                 remove(fullpath)
 
-        def mk_mplog():
-            return log_to_stderr()
+        def send(topic, payload):
+            if not cfg.config.relay.socket_path:
+                raise ValueError('no relay socket_path')
+            relay_send(cfg.config.relay.socket_path, topic, payload)
 
         return dict(cli=cli, cfg=cfg,
-                    mk_mqtt=partial(MqttClient.make, cfg.config.broker.host,
-                                    cfg.config.broker.port),
-                    mk_notify=partial(PushoverNotify.make,
-                                      urlencode=urlencode,
-                                      connection=HTTPSConnection,
-                                      token=cfg.config.pushover.token,
-                                      user=cfg.config.pushover.user),
-                    mk_nfc=partial(NfcInterface.make, nfc=nfc, now=now),
-                    sleep=sleep, blink=blink, now=now,
+                    mk_mqtt=mk_mqtt, mk_hub=mk_hub, mk_notify=mk_notify,
+                    mk_nfc=mk_nfc, sleep=sleep, blink=blink, now=now,
                     is_motion_on=is_motion_on, motion_on=motion_on,
                     motion_off=motion_off, reboot=reboot,
-                    mk_fmq=FileManagerQueue.make,
-                    upload=partial(
-                        upload,
-                        path=cfg.config.filemanager.filestore_path,
-                        s3_dest=cfg.config.filemanager.s3_dest,
-                        oc_url=cfg.config.filemanager.oc_url,
-                        oc_user=cfg.config.filemanager.oc_user,
-                        oc_password=cfg.config.filemanager.oc_password,
-                        oc_subdir=cfg.config.filemanager.oc_subdir),
-                    delete=partial(delete,
-                                   path=cfg.config.filemanager.filestore_path),
-                    mk_mplog=mk_mplog)
+                    usb_reset=usb_reset, mk_fmq=mk_fmq,
+                    upload=upload, delete=delete, mk_relay=mk_relay,
+                    relay_send=send, mk_trace=mk_trace, mk_queue=mk_queue,
+                    mk_journal=mk_journal, mk_index=mk_index)
 
     if cli.version:
         from version import VERSION_STRING
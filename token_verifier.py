@@ -0,0 +1,103 @@
+from collections import deque
+from datetime import timedelta
+
+
+class TokenVerifier(object):
+    ''' Verify time-salted tokens against a sliding window of precomputed
+    hashes.  The window covers now +/- window_sec and is advanced one second
+    at a time, so each verification is a dictionary lookup plus (at most) a
+    couple of new hashes rather than a search of the whole window.
+
+    >>> import datetime as dt
+    >>> from things2c import dt_salted_hash
+    >>> clock = [dt.datetime(2016, 1, 1, 0, 0, 0)]
+    >>> def now(as_datetime): return clock[0]
+    >>> tv = TokenVerifier.make(secret='mysecretkey', now=now,
+    ...                         hash_fn=dt_salted_hash)
+    >>> tv.authorized('35a86879588c32b6299f562ebb70d7926c6e4bc8')
+    True
+    >>> tv.authorized('xxx')
+    False
+    >>> len(tv)
+    61
+    >>> clock[0] += dt.timedelta(seconds=30)
+    >>> tv.authorized('35a86879588c32b6299f562ebb70d7926c6e4bc8')
+    True
+    >>> clock[0] += dt.timedelta(seconds=1)
+    >>> tv.authorized('35a86879588c32b6299f562ebb70d7926c6e4bc8')
+    False
+    >>> len(tv)
+    61
+    >>> clock[0] = dt.datetime(2015, 12, 31, 23, 59, 59, 999)
+    >>> tv.authorized('35a86879588c32b6299f562ebb70d7926c6e4bc8')
+    True
+    >>> tv.rekey('othersecret')
+    >>> tv.authorized('35a86879588c32b6299f562ebb70d7926c6e4bc8')
+    False
+    '''
+    def __init__(self, secret, now, hash_fn, window_sec):
+        self._secret = secret
+        self._now = now
+        self._hash_fn = hash_fn
+        self._window = timedelta(seconds=window_sec)
+        self._one_sec = timedelta(seconds=1)
+        # (datetime, hash) in time order and hash -> datetime for lookups
+        self._times = deque()
+        self._hashes = dict()
+
+    @classmethod
+    def make(cls, secret, now, hash_fn, window_sec=30):
+        return TokenVerifier(secret, now, hash_fn, window_sec)
+
+    def rekey(self, secret):
+        ''' Switch to a new secret (e.g. after a configuration reload) '''
+        if secret != self._secret:
+            self._secret = secret
+            self._times.clear()
+            self._hashes.clear()
+
+    def __len__(self):
+        return len(self._times)
+
+    def authorized(self, candidate):
+        self._advance(self._now(as_datetime=True).replace(microsecond=0))
+        return candidate in self._hashes
+
+    def _add(self, dt, left=False):
+        h = self._hash_fn(self._secret, dt)
+        if left:
+            self._times.appendleft((dt, h))
+        else:
+            self._times.append((dt, h))
+        self._hashes[h] = dt
+
+    def _discard(self, entry):
+        dt, h = entry
+        if self._hashes.get(h) == dt:
+            del self._hashes[h]
+
+    def _advance(self, current):
+        lo, hi = current - self._window, current + self._window
+        if not self._times or lo > self._times[-1][0] or \
+           hi < self._times[0][0]:
+            # First use or the clock jumped past the whole window - rebuild
+            self._times.clear()
+            self._hashes.clear()
+            t = lo
+            while t <= hi:
+                self._add(t)
+                t += self._one_sec
+            return
+
+        while self._times and self._times[0][0] < lo:
+            self._discard(self._times.popleft())
+        while self._times and self._times[-1][0] > hi:
+            self._discard(self._times.pop())
+        t = self._times[-1][0] + self._one_sec
+        while t <= hi:
+            self._add(t)
+            t += self._one_sec
+        t = self._times[0][0] - self._one_sec
+        while t >= lo:
+            self._add(t, left=True)
+            t -= self._one_sec
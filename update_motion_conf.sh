@@ -1,5 +1,7 @@
 motion_cfg=$1
 storage_dir=$2
+# $3 is the log file; the hooks hand events to the relay on this socket
+relay_socket=${4:-/run/things2c/relay.sock}
 
 # "daemon off"
 sed -i -E "s/^(daemon)\s+on(.*)?/\1 off/g" $motion_cfg
@@ -27,14 +29,14 @@ sed -i -E "s/^(picture_filename)\s+(.*)?/\1 %Y%m%d%H%M%S-%q/g" $motion_cfg
 # "movie filename"
 sed -i -E "s/^(movie_filename)\s+(.*)?/\1 %Y%m%d%H%M%S/g" $motion_cfg
 # "script for when events start"
-sed -i -E "s/^(;)?(\s+)?(on_event_start)\s+(.*)?/\3 things2c notify Motion; things2c publish --topic motion_event_start/g" $motion_cfg
+sed -i -E "s@^(;)?(\s+)?(on_event_start)\s+(.*)?@\3 things2c-relay --socket=$relay_socket motion_event_start@g" $motion_cfg
 # "script for when events end"
-sed -i -E "s/^(;)?(\s+)?(on_event_end)\s+(.*)?/\3 things2c publish --topic motion_event_end/g" $motion_cfg
+sed -i -E "s@^(;)?(\s+)?(on_event_end)\s+(.*)?@\3 things2c-relay --socket=$relay_socket motion_event_end@g" $motion_cfg
 # "script for when motion is detected"
-sed -i -E "s/^(;)?(\s+)?(on_motion_detected)\s+(.*)?/\3 things2c publish --topic motion_detected/g" $motion_cfg
+sed -i -E "s@^(;)?(\s+)?(on_motion_detected)\s+(.*)?@\3 things2c-relay --socket=$relay_socket motion_detected@g" $motion_cfg
 # "script for when movie has ended"
-sed -i -E "s/^(;)?(\s+)?(on_movie_end)\s+(.*)?/\3 things2c publish --topic motion_filesync_queue --payload=%f/g" $motion_cfg
+sed -i -E "s@^(;)?(\s+)?(on_movie_end)\s+(.*)?@\3 things2c-relay --socket=$relay_socket motion_filesync_queue %f@g" $motion_cfg
 # "script for when picture has been saved"
-sed -i -E "s/^(;)?(\s+)?(on_picture_save)\s+(.*)?/\3 things2c publish --topic motion_filesync_queue --payload=%f/g" $motion_cfg
+sed -i -E "s@^(;)?(\s+)?(on_picture_save)\s+(.*)?@\3 things2c-relay --socket=$relay_socket motion_filesync_queue %f@g" $motion_cfg
 # "don't restrict streaming to localhost"
 sed -i -E "s/^(stream_localhost)\s+on(.*)?/\1 off/g" $motion_cfg